@@ -0,0 +1,159 @@
+"""
+Module that follows HTCondor job event logs of submitted RelMons
+"""
+import logging
+import re
+import threading
+import time
+from mongodb_database import Database
+from local.ssh_executor import SSHExecutor
+
+
+class CondorEventWatcher():
+    """
+    Condor event watcher follows RELMON_<id>.log user logs of tracked jobs
+    over a long lived SSH channel and saves job status as soon as an event
+    is written
+    When a job terminates or is aborted, on_finished callback is called, so
+    controller could collect output without waiting for the next tick
+    """
+
+    # Event numbers of HTCondor user log and job status they lead to
+    EVENT_STATUSES = {'000': 'IDLE',  # Submit
+                      '001': 'RUN',  # Execute
+                      '004': 'IDLE',  # Evicted
+                      '005': 'DONE',  # Terminated
+                      '009': 'REMOVED',  # Aborted
+                      '012': 'HOLD',  # Held
+                      '013': 'IDLE'}  # Released
+    # Event line, for example "005 (801341.000.000) 10/18 20:13:59 Job terminated."
+    EVENT_REGEX = re.compile(r'^(\d{3}) \((\d+)\.\d+\.\d+\) ')
+
+    def __init__(self, config, on_finished, refresh_interval=30):
+        self.logger = logging.getLogger('logger')
+        self.remote_directory = config['remote_directory']
+        if self.remote_directory[-1] == '/':
+            self.remote_directory = self.remote_directory[:-1]
+
+        self.ssh_executor = SSHExecutor(config)
+        self.on_finished = on_finished
+        self.refresh_interval = refresh_interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start following logs in a background thread
+        """
+        self.thread = threading.Thread(target=self.run, name='condor_event_watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop following logs and wait for background thread to finish
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+
+    def get_tracked_jobs(self):
+        """
+        Return dictionary of HTCondor cluster ids and RelMon ids of RelMons
+        that are waiting for their jobs
+        """
+        database = Database()
+        tracked_jobs = {}
+        for status in ('submitted', 'running', 'finishing'):
+            for relmon_json in database.get_relmons_with_status(status):
+                condor_id = relmon_json.get('condor_id', 0)
+                if condor_id > 0:
+                    tracked_jobs[condor_id] = relmon_json['_id']
+
+        return tracked_jobs
+
+    def get_follow_command(self, tracked_jobs):
+        """
+        Return command that prints whole logs of tracked jobs and follows them
+        Logs are read from the beginning, so no event is lost between restarts
+        """
+        log_files = ['%s/%s/RELMON_%s.log' % (self.remote_directory, relmon_id, relmon_id)
+                     for relmon_id in sorted(tracked_jobs.values())]
+        return 'tail -q -n +1 -F %s 2>/dev/null' % (' '.join(log_files))
+
+    def save_statuses(self, tracked_jobs, statuses):
+        """
+        Save latest statuses of jobs and return whether any of them finished
+        """
+        database = Database()
+        finished = False
+        for condor_id, condor_status in statuses.items():
+            relmon_id = tracked_jobs.get(condor_id)
+            if not relmon_id:
+                continue
+
+            if database.set_condor_status(relmon_id, condor_id, condor_status):
+                self.logger.info('Job %s of %s is %s', condor_id, relmon_id, condor_status)
+                finished = finished or condor_status in ('DONE', 'REMOVED')
+
+        return finished
+
+    def follow(self, tracked_jobs):
+        """
+        Follow logs of tracked jobs until list of tracked jobs changes
+        Statuses are saved once output is idle, so replayed older events do
+        not overwrite the latest status
+        """
+        statuses = {}
+        next_refresh = time.time() + self.refresh_interval
+        lines = self.ssh_executor.stream_command(self.get_follow_command(tracked_jobs))
+        try:
+            for line in lines:
+                if line is not None:
+                    match = self.EVENT_REGEX.match(line)
+                    if match and match.group(1) in self.EVENT_STATUSES:
+                        statuses[int(match.group(2))] = self.EVENT_STATUSES[match.group(1)]
+
+                    continue
+
+                if statuses:
+                    if self.save_statuses(tracked_jobs, statuses):
+                        self.on_finished()
+
+                    statuses = {}
+
+                if self.stop_event.is_set():
+                    return
+
+                if time.time() > next_refresh:
+                    next_refresh = time.time() + self.refresh_interval
+                    if self.get_tracked_jobs() != tracked_jobs:
+                        return
+
+            self.logger.warning('Following condor events ended unexpectedly')
+            self.stop_event.wait(self.refresh_interval)
+        finally:
+            lines.close()
+
+    def run(self):
+        """
+        Follow logs of tracked jobs until watcher is stopped
+        Connection errors are logged and following is restarted, polling in
+        controller ticks covers the gap
+        """
+        self.logger.info('Condor event watcher started')
+        while not self.stop_event.is_set():
+            try:
+                tracked_jobs = self.get_tracked_jobs()
+                if tracked_jobs:
+                    self.logger.info('Following events of %s jobs', len(tracked_jobs))
+                    self.follow(tracked_jobs)
+                else:
+                    self.stop_event.wait(self.refresh_interval)
+
+            except Exception as ex:
+                self.logger.error('Error following condor events: %s', ex)
+                self.ssh_executor.close_connections()
+                self.stop_event.wait(self.refresh_interval)
+
+        self.ssh_executor.close_connections()
+        self.logger.info('Condor event watcher stopped')
@@ -8,6 +8,7 @@ import time
 import os.path
 import shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from multiprocessing import Manager
 from mongodb_database import Database
 from local.ssh_executor import SSHExecutor
@@ -22,6 +23,16 @@ class Controller():
     Performs ticks during which RelMons are deleted, reset, submitted
     and their status is checked (if they are running)
     """
+
+    # HTCondor JobStatus numbers and their names
+    CONDOR_STATUSES = {'0': 'UNEXPLAINED',
+                       '1': 'IDLE',
+                       '2': 'RUN',
+                       '3': 'REMOVED',
+                       '4': 'DONE',
+                       '5': 'HOLD',
+                       '6': 'SUBMISSION ERROR'}
+
     def __init__(self, config):
         self.logger = logging.getLogger('logger')
         self.logger.info('***** Creating a controller! *****')
@@ -36,6 +47,13 @@ class Controller():
         self.config = config
         self.service_url = self.config['service_url']
         self.reports_url = self.config['reports_url']
+        # Number of RelMons that are handled at once in each phase of a tick
+        # Each of them might use an SSH and an SFTP channel of the same connection,
+        # so together they should stay below MaxSessions of sshd (10 by default)
+        self.phase_workers = {}
+        for phase in ('delete', 'reset', 'collect', 'submit'):
+            self.phase_workers[phase] = int(config.get('tick_%s_workers' % (phase), 4))
+
         # Multithread manager
         manager = Manager()
         # Lists of relmon ids
@@ -58,21 +76,25 @@ class Controller():
         self.logger.info('Controller will tick')
         tick_start = time.time()
         # Delete relmons
+        relmons_to_delete = list(self.relmons_to_delete)
         self.logger.info('Relmons to delete (%s): %s.',
-                         len(self.relmons_to_delete),
-                         ','.join([x['id'] for x in self.relmons_to_delete]))
-        for relmon_dict in self.relmons_to_delete:
-            relmon_id = relmon_dict['id']
-            self.__delete_relmon(relmon_id, database)
+                         len(relmons_to_delete),
+                         ','.join([x['id'] for x in relmons_to_delete]))
+        self.__run_phase('delete',
+                         lambda x: self.__delete_relmon(x['id'], database),
+                         relmons_to_delete)
+        for relmon_dict in relmons_to_delete:
             self.relmons_to_delete.remove(relmon_dict)
 
         # Reset relmons
+        relmons_to_reset = list(self.relmons_to_reset)
         self.logger.info('Relmons to reset (%s): %s.',
-                         len(self.relmons_to_reset),
-                         ', '.join([x['id'] for x in self.relmons_to_reset]))
-        for relmon_dict in self.relmons_to_reset:
-            relmon_id = relmon_dict['id']
-            self.__reset_relmon(relmon_id, database, relmon_dict['user_info'])
+                         len(relmons_to_reset),
+                         ', '.join([x['id'] for x in relmons_to_reset]))
+        self.__run_phase('reset',
+                         lambda x: self.__reset_relmon(x['id'], database, x['user_info']),
+                         relmons_to_reset)
+        for relmon_dict in relmons_to_reset:
             self.relmons_to_reset.remove(relmon_dict)
 
         # Check relmons
@@ -90,31 +112,35 @@ class Controller():
         self.logger.info('Relmons to check (%s): %s.',
                          len(relmons_to_check),
                          ', '.join(r.get('id') for r in relmons_to_check))
+        self.__check_if_running([RelMon(r) for r in relmons_to_check], database)
+        relmons_to_collect = []
         for relmon_json in relmons_to_check:
-            relmon = RelMon(relmon_json)
-            self.__check_if_running(relmon, database)
-            relmon = RelMon(database.get_relmon(relmon.get_id()))
+            # Refetch after check if running save
+            relmon = RelMon(database.get_relmon(relmon_json['id']))
             condor_status = relmon.get_condor_status()
             if condor_status in ('DONE', 'REMOVED'):
-                # Refetch after check if running save
-                self.__collect_output(relmon, database)
+                relmons_to_collect.append(relmon)
+
+        self.__run_phase('collect',
+                         lambda x: self.__collect_output(x, database),
+                         relmons_to_collect)
 
         # Submit relmons
         relmons_to_submit = database.get_relmons_with_status('new')
         self.logger.info('Relmons to submit (%s): %s.',
                          len(relmons_to_submit),
                          ', '.join(r.get('id') for r in relmons_to_submit))
-        for relmon_json in relmons_to_submit:
-            relmon = RelMon(relmon_json)
-            status = relmon.get_status()
-            if status == 'new':
-                # Double check and if it is new, submit it
-                self.__submit_to_condor(relmon, database)
+        # Double check and if it is new, submit it
+        relmons_to_submit = [RelMon(r) for r in relmons_to_submit]
+        self.__run_phase('submit',
+                         lambda x: self.__submit_to_condor(x, database),
+                         [r for r in relmons_to_submit if r.get_status() == 'new'])
 
         self.ssh_executor.close_connections()
         tick_end = time.time()
         self.logger.info('Controller tick finished. Took %.2fs',
                          tick_end - tick_start)
+        self.logger.info('Database pool statistics: %s', Database.get_pool_statistics())
 
     def add_to_reset_list(self, relmon_id, user_info):
         """
@@ -208,9 +234,18 @@ class Controller():
                     'EXISTING_REPORT=$(ls -1 %s*.sqlite | head -n 1)' % (relmon_id),
                     'echo "Existing file name: $EXISTING_REPORT"',
                     'mv "$EXISTING_REPORT" "%s___%s.sqlite"' % (relmon_id, new_name),
+                    # Names are sanitized, so they can be used in query
+                    'if [ -f %s ]; then sqlite3 -cmd ".timeout 120000" %s '
+                    '"UPDATE reports SET name = \'%s\', file_name = \'%s___%s\' '
+                    'WHERE id = \'%s\';"; fi' % (self.file_creator.REPORTS_CATALOG,
+                                                  self.file_creator.REPORTS_CATALOG,
+                                                  new_name,
+                                                  relmon_id,
+                                                  new_name,
+                                                  relmon_id),
                 ])
-                old_relmon.set_user_info(user_info)
-                database.update_relmon(old_relmon)
+                database.set_relmon_fields(relmon_id, {'name': new_name,
+                                                       'user_info': user_info})
             elif categories_changed:
                 # Categories changed, will have to resubmit
                 new_name = new_relmon.get_name()
@@ -234,6 +269,31 @@ class Controller():
 
         self.logger.info('Relmon %s was edited', old_relmon)
 
+    def __run_phase(self, phase, function, items):
+        """
+        Call function with each item on a pool of worker threads
+        Items of a phase belong to different RelMons and phases run one after
+        another, so actions of a single RelMon keep their order
+        """
+        if not items:
+            return
+
+        workers = max(1, min(self.phase_workers[phase], len(items)))
+        self.logger.info('Running %s phase for %s RelMons with %s workers',
+                         phase,
+                         len(items),
+                         workers)
+        phase_start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(function, item): item for item in items}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as ex:
+                    self.logger.error('Error in %s phase for %s: %s', phase, futures[future], ex)
+
+        self.logger.info('Finished %s phase in %.2fs', phase, time.time() - phase_start)
+
     def __submit_to_condor(self, relmon, database):
         """
         Take relmon object and submit it to HTCondor
@@ -266,9 +326,19 @@ class Controller():
 
             self.logger.info('Will prepare remote directory for %s', relmon)
             # Prepare remote directory. Delete old one and create a new one
+            # Give job a copy of shared cmsweb cache, empty file is a valid empty cache
+            # Copy goes through a temporary file, so job never gets a partial copy
+            shared_cache = '%s/%s' % (self.remote_directory, self.file_creator.CMSWEB_CACHE)
+            job_cache = '%s/%s' % (remote_relmon_directory, self.file_creator.CMSWEB_CACHE)
             self.ssh_executor.execute_command([
                 'rm -rf %s' % (remote_relmon_directory),
-                'mkdir -p %s' % (remote_relmon_directory)
+                'mkdir -p %s' % (remote_relmon_directory),
+                '(cp %s %s.tmp && mv -f %s.tmp %s) || (rm -f %s.tmp; touch %s)' % (shared_cache,
+                                                                                 job_cache,
+                                                                                 job_cache,
+                                                                                 job_cache,
+                                                                                 job_cache,
+                                                                                 job_cache)
             ])
 
             self.logger.info('Will upload files for %s', relmon)
@@ -286,13 +356,13 @@ class Controller():
             # Run condor_submit
             # Submission happens through lxplus as condor is not available on website machine
             # It is easier to ssh to lxplus than set up condor locally
-            stdout, stderr = self.ssh_executor.execute_command([
+            stdout, stderr, exit_code = self.ssh_executor.execute_command([
                 'cd %s' % (remote_relmon_directory),
                 'voms-proxy-init -voms cms --valid 24:00 --out $(pwd)/proxy.txt',
                 'module load lxbatch/tzero && condor_submit RELMON_%s.sub' % (relmon_id)
             ])
             # Parse result of condor_submit
-            if not stderr and '1 job(s) submitted to cluster' in stdout:
+            if exit_code == 0 and not stderr and '1 job(s) submitted to cluster' in stdout:
                 # output is "1 job(s) submitted to cluster 801341"
                 relmon.set_status('submitted')
                 condor_id = int(float(stdout.split()[-1]))
@@ -311,43 +381,85 @@ class Controller():
             self.logger.error('Exception while trying to submit %s: %s', relmon, str(ex))
 
         self.logger.info('%s status is %s', relmon, relmon.get_status())
-        database.update_relmon(relmon)
+        # Job might already be sending progress updates, so set only submission fields
+        database.set_relmon_fields(relmon_id, {'status': relmon.get_status(),
+                                               'condor_id': relmon.get_condor_id(),
+                                               'condor_status': relmon.get_condor_status()})
 
-    def __check_if_running(self, relmon, database):
+    def __get_condor_statuses(self, command, condor_ids, timeout=60):
         """
-        Check if given RelMon is running in HTCondor and get it's status there
+        Run condor_q or condor_history for given cluster ids and return
+        dictionary of cluster ids and their status names
+        Return None if command failed or timed out
         """
-        relmon_condor_id = relmon.get_condor_id()
-        self.logger.info('Will check if %s is running in HTCondor, id: %s',
-                         relmon,
-                         relmon_condor_id)
-        stdout, stderr = self.ssh_executor.execute_command(
-            'module load lxbatch/tzero && condor_q -af:h ClusterId JobStatus | '
-            'grep %s' % (relmon_condor_id)
+        constraint = ' || '.join('ClusterId == %s' % (condor_id) for condor_id in condor_ids)
+        stdout, stderr, exit_code = self.ssh_executor.execute_command(
+            'module load lxbatch/tzero && %s -constraint \'%s\' -af ClusterId JobStatus' % (
+                command,
+                constraint),
+            timeout=timeout
         )
-        new_condor_status = '<unknown>'
-        if stdout and not stderr:
-            status_number = stdout.split()[-1]
-            self.logger.info('Relmon %s status is %s', relmon, status_number)
-            status_dict = {
-                '0': 'UNEXPLAINED',
-                '1': 'IDLE',
-                '2': 'RUN',
-                '3': 'REMOVED',
-                '4': 'DONE',
-                '5': 'HOLD',
-                '6': 'SUBMISSION ERROR'
-            }
-            new_condor_status = status_dict.get(status_number, 'REMOVED')
-        else:
-            self.logger.error('Error with HTCondor?\nOutput: %s.\nError %s',
-                              stdout,
-                              stderr)
+        if stderr or exit_code != 0:
+            self.logger.error('Error with HTCondor?\nOutput: %s.\nError %s', stdout, stderr)
+            return None
 
-        relmon = RelMon(database.get_relmon(relmon.get_id()))
-        self.logger.info('Saving %s condor status as %s', relmon, new_condor_status)
-        relmon.set_condor_status(new_condor_status)
-        database.update_relmon(relmon)
+        statuses = {}
+        for line in stdout.splitlines():
+            line = line.split()
+            if len(line) != 2 or not line[0].isdigit():
+                continue
+
+            statuses[int(line[0])] = self.CONDOR_STATUSES.get(line[1], 'UNEXPLAINED')
+
+        return statuses
+
+    def __check_if_running(self, relmons, database):
+        """
+        Check if given RelMons are running in HTCondor and get their status there
+        All jobs are queried with a single condor_q and jobs that left the queue
+        are looked up with a single condor_history
+        """
+        relmons = [r for r in relmons if r.get_condor_id() > 0]
+        if not relmons:
+            return
+
+        condor_ids = sorted(set(r.get_condor_id() for r in relmons))
+        self.logger.info('Will check if %s jobs are running in HTCondor: %s',
+                         len(condor_ids),
+                         ', '.join(str(x) for x in condor_ids))
+        statuses = self.__get_condor_statuses('condor_q', condor_ids)
+        if statuses is None:
+            return
+
+        left_queue = [x for x in condor_ids if x not in statuses]
+        if left_queue:
+            self.logger.info('Jobs not in the queue, will check history: %s',
+                             ', '.join(str(x) for x in left_queue))
+            # History is read until all jobs are found, if some job is not
+            # there, whole history is scanned, so it might take a while
+            history_statuses = self.__get_condor_statuses(
+                'condor_history -limit %s' % (len(left_queue)),
+                left_queue,
+                timeout=600
+            )
+            if history_statuses is not None:
+                statuses.update(history_statuses)
+                # Jobs that are neither in the queue nor in history are gone
+                for condor_id in left_queue:
+                    if condor_id not in statuses:
+                        self.logger.warning('Job %s is not in queue or history', condor_id)
+                        statuses[condor_id] = 'REMOVED'
+
+        for relmon in relmons:
+            new_condor_status = statuses.get(relmon.get_condor_id())
+            if new_condor_status is None:
+                # Status is not known because condor_history failed, check next tick
+                continue
+
+            self.logger.info('Saving %s condor status as %s', relmon, new_condor_status)
+            database.set_condor_status(relmon.get_id(),
+                                       relmon.get_condor_id(),
+                                       new_condor_status)
 
     def __collect_output(self, relmon, database):
         """
@@ -410,9 +522,38 @@ class Controller():
         else:
             self.__send_failed_notification(relmon, files=attachments)
 
-        database.update_relmon(relmon)
+        database.set_relmon_fields(relmon_id,
+                                   {'status': relmon.get_status()},
+                                   condor_id=relmon.get_condor_id())
         shutil.rmtree(local_relmon_directory, ignore_errors=True)
+        # Merge cmsweb cache that job brought back to shared cache for the next jobs
+        shared_cache = '%s/%s' % (self.remote_directory, self.file_creator.CMSWEB_CACHE)
+        job_cache = '%s/%s' % (remote_relmon_directory, self.file_creator.CMSWEB_CACHE)
+        # Merge is done in a copy that atomically replaces shared cache, so jobs
+        # never get a partial file. If outputs of two RelMons are collected at
+        # the same time, entries of one of them might be lost, which is fine
+        # for a cache. If shared cache is broken, it is replaced by job's cache
+        merge_query = ('ATTACH \'%s\' AS job; '
+                       'INSERT OR REPLACE INTO main.cache SELECT j.* FROM job.cache j '
+                       'LEFT JOIN main.cache m ON m.key = j.key '
+                       'WHERE m.key IS NULL OR j.last_used > m.last_used;' % (job_cache))
+        tmp_cache = '%s.%s' % (shared_cache, relmon_id)
+        merge_command = 'cp %s %s && sqlite3 %s "%s" && mv -f %s %s' % (shared_cache,
+                                                                        tmp_cache,
+                                                                        tmp_cache,
+                                                                        merge_query,
+                                                                        tmp_cache,
+                                                                        shared_cache)
+        replace_command = 'cp %s %s && mv -f %s %s' % (job_cache,
+                                                       tmp_cache,
+                                                       tmp_cache,
+                                                       shared_cache)
         self.ssh_executor.execute_command([
+            'if [ -s %s ]; then ([ -s %s ] && %s) || (%s); fi' % (job_cache,
+                                                                  shared_cache,
+                                                                  merge_command,
+                                                                  replace_command),
+            'rm -f %s' % (tmp_cache),
             'rm -rf %s' % (remote_relmon_directory)
         ])
 
@@ -18,11 +18,12 @@ class EmailSender():
     def __init__(self, config):
         self.logger = logging.getLogger('logger')
         self.credentials = config['ssh_credentials']
-        self.smtp = None
 
     def __setup_smtp(self):
         """
-        Read credentials and connect to SMTP file
+        Read credentials, connect to SMTP server and return the connection
+        Each email gets it's own connection, so emails can be sent from
+        multiple threads
         """
         if ':' not in self.credentials:
             with open(self.credentials) as json_file:
@@ -33,19 +34,13 @@ class EmailSender():
             credentials['password'] = self.credentials.split(':')[1]
 
         self.logger.info('Credentials loaded successfully: %s', credentials['username'])
-        self.smtp = smtplib.SMTP(host='smtp.cern.ch', port=587)
-        # self.smtp.connect()
-        self.smtp.ehlo()
-        self.smtp.starttls()
-        self.smtp.ehlo()
-        self.smtp.login(credentials['username'], credentials['password'])
-
-    def __close_smtp(self):
-        """
-        Close connection to SMTP server
-        """
-        self.smtp.quit()
-        self.smtp = None
+        smtp = smtplib.SMTP(host='smtp.cern.ch', port=587)
+        # smtp.connect()
+        smtp.ehlo()
+        smtp.starttls()
+        smtp.ehlo()
+        smtp.login(credentials['username'], credentials['password'])
+        return smtp
 
     def send(self, subject, body, recipients, files=None):
         """
@@ -75,10 +70,10 @@ class EmailSender():
                 message.attach(attachment)
 
         self.logger.info('Will send "%s" to %s', message['Subject'], message['To'])
-        self.__setup_smtp()
+        smtp = self.__setup_smtp()
         try:
-            self.smtp.sendmail(message['From'], recipients + ccs, message.as_string())
+            smtp.sendmail(message['From'], recipients + ccs, message.as_string())
         except Exception as ex:
             self.logger.error(ex)
         finally:
-            self.__close_smtp()
+            smtp.quit()
@@ -9,6 +9,11 @@ class FileCreator():
     File creator creates bash executable for condor and condor submission job file
     """
 
+    # Name of cmsweb response cache file that is given to jobs
+    CMSWEB_CACHE = 'cmsweb_cache.sqlite'
+    # Name of catalog of published reports in web location
+    REPORTS_CATALOG = 'reports_catalog.db'
+
     def __init__(self, config):
         self.remote_location = config['remote_directory']
         self.web_location = config['web_location']
@@ -54,9 +59,11 @@ class FileCreator():
             'mkdir -p Reports',
             # Run the remote apparatus
             'python relmonservice2/remote/remote_apparatus.py '  # No newline
-            '-r RELMON_%s.json -p proxy.txt --cpus %s --callback %s' % (relmon_id,
-                                                                        cpus,
-                                                                        self.callback_url),
+            '-r RELMON_%s.json -p proxy.txt --cpus %s --units %s --callback %s' % (
+                relmon_id,
+                cpus,
+                relmon.get_units(),
+                self.callback_url),
             # Close scope for CMSSW
             ')',
             'cd $DIR',
@@ -99,6 +106,11 @@ class FileCreator():
             # Do integrity check
             'echo "Integrity check:"',
             'echo "PRAGMA integrity_check;" | sqlite3 %s' % (web_sqlite_path),
+            # Update catalog, so report listing does not have to open report files
+            'python3 $DIR/relmonservice2/remote/report_catalog.py --catalog "%s/%s" add %s' % (
+                self.web_location,
+                self.REPORTS_CATALOG,
+                web_sqlite_path),
             'cd $DIR',
             'cern-get-sso-cookie -u %s -o cookie.txt' % (self.cookie_url),
             'cp cookie.txt relmonservice2/remote',
@@ -135,7 +147,9 @@ class FileCreator():
             'output                 = RELMON_%s.out' % (relmon_id),
             'error                  = RELMON_%s.err' % (relmon_id),
             'log                    = RELMON_%s.log' % (relmon_id),
-            'transfer_input_files   = RELMON_%s.json,proxy.txt' % (relmon_id),
+            # Cache of cmsweb responses is shared among jobs
+            'transfer_input_files   = RELMON_%s.json,proxy.txt,%s' % (relmon_id,
+                                                                   self.CMSWEB_CACHE),
             'when_to_transfer_output = on_exit',
             'request_cpus           = %s' % (cpus),
             'request_memory         = %s' % (memory),
@@ -94,6 +94,8 @@ class RelMon():
         """
         category = self.get_category(category_name)
         category['status'] = 'initial'
+        category.pop('hlt_status', None)
+        category.pop('no_hlt_status', None)
         new_references = []
         for old_reference in category['reference']:
             if isinstance(old_reference, str):
@@ -140,6 +142,8 @@ class RelMon():
         self.set_status('new')
         self.set_condor_status('<unknown>')
         self.set_condor_id(0)
+        # New job starts a new sequence of progress updates
+        self.data['last_sequence'] = 0
         for category in self.data['categories']:
             self.reset_category(category['name'])
 
@@ -195,11 +199,18 @@ class RelMon():
 
         return cpus
 
+    def get_units(self):
+        """
+        Return number of ValidationMatrix runs that job may run concurrently
+        """
+        return min(2, self.get_cpu())
+
     def get_memory(self):
         """
-        Return amount of memory required based on number of CPUs
+        Return amount of memory required based on number of CPUs and
+        number of concurrent ValidationMatrix runs
         """
-        memory = str(self.get_cpu() * 2) + 'G'
+        memory = str(self.get_cpu() * 2 + (self.get_units() - 1) * 2) + 'G'
         return memory
 
     def get_disk(self):
@@ -225,6 +236,49 @@ class RelMon():
         """
         return self.data
 
+    def update_summary(self):
+        """
+        Count total, downloaded and compared relvals of the whole RelMon
+        and status histograms and sizes of references and targets of each category
+        Counters are stored in RelMon dictionary, so list of RelMons could be
+        shown without references and targets
+        """
+        return RelMon.summarize(self.data)
+
+    @staticmethod
+    def summarize(data):
+        """
+        Add progress summary to a RelMon dictionary without normalizing it
+        """
+        total_relvals = 0
+        downloaded_relvals = 0
+        compared_relvals = 0
+        for category in data.get('categories', []):
+            category_done = category.get('status') == 'done'
+            for relval_type in ('reference', 'target'):
+                relvals = category.get(relval_type, [])
+                relval_status = {}
+                relval_size = 0
+                for relval in relvals:
+                    status = relval['status']
+                    relval_status[status] = relval_status.get(status, 0) + 1
+                    relval_size += relval.get('file_size', 0)
+                    if status != 'initial':
+                        downloaded_relvals += 1
+
+                    if category_done:
+                        compared_relvals += 1
+
+                total_relvals += len(relvals)
+                category['%s_total' % (relval_type)] = len(relvals)
+                category['%s_status' % (relval_type)] = relval_status
+                category['%s_size' % (relval_type)] = relval_size
+
+        data['total_relvals'] = total_relvals
+        data['downloaded_relvals'] = downloaded_relvals
+        data['compared_relvals'] = compared_relvals
+        return data
+
     def get_status(self):
         """
         Getter for status
@@ -0,0 +1,224 @@
+"""
+Module that serves report pages straight from report SQLite files
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import Blueprint, current_app, make_response, redirect, request, url_for
+
+
+report_blueprint = Blueprint('reports', __name__)
+
+
+class ReportFile():
+    """
+    Read-only handle of a single report file
+    Build identity changes whenever file is replaced
+    """
+
+    def __init__(self, file_path, mmap_size):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.file_stat = os.stat(file_path)
+        self.last_check = time.time()
+        self.build = ReportFile.get_build(self.file_stat)
+        # File is replaced, not modified in place, so it can be opened as immutable
+        self.connection = sqlite3.connect('file:%s?mode=ro&immutable=1' % (file_path),
+                                          uri=True,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA mmap_size = %s;' % (int(mmap_size)))
+        self.schema_version = self.connection.execute('PRAGMA user_version;').fetchone()[0]
+        # Category name and whether it is deduplicated
+        self.categories = {}
+        if self.schema_version >= 2:
+            for category, deduplicated in self.connection.execute('SELECT category, deduplicated '
+                                                                  'FROM metadata'):
+                self.categories[category] = bool(deduplicated)
+
+    @staticmethod
+    def get_build(file_stat):
+        """
+        Return build identity of a file based on it's inode, modification time and size
+        """
+        identity = '%s-%s-%s' % (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+    def is_replaced(self, check_interval):
+        """
+        Return whether file was replaced since it was opened
+        File is checked at most once in check interval
+        """
+        now = time.time()
+        if now - self.last_check < check_interval:
+            return False
+
+        self.last_check = now
+        try:
+            file_stat = os.stat(self.file_path)
+        except OSError:
+            return True
+
+        return ReportFile.get_build(file_stat) != self.build
+
+    def get_file(self, category, path):
+        """
+        Return gzip compressed content of a file or None if it does not exist
+        """
+        with self.lock:
+            if category not in self.categories and self.schema_version < 2:
+                # Old files have no metadata, so look at table columns
+                columns = [row[1] for row in self.connection.execute('PRAGMA table_info(%s);'
+                                                                     % (category))]
+                if 'htmlgz' in columns or 'hash' in columns:
+                    self.categories[category] = 'hash' in columns
+
+            if category not in self.categories:
+                return None
+
+            if self.categories[category]:
+                query = ('SELECT blobs.htmlgz FROM %s JOIN blobs ON blobs.hash = %s.hash '
+                         'WHERE %s.path = ?' % (category, category, category))
+            else:
+                query = 'SELECT htmlgz FROM %s WHERE path = ?' % (category)
+
+            row = self.connection.execute(query, ('%s/%s' % (category, path), )).fetchone()
+
+        return bytes(row[0]) if row else None
+
+    def close(self):
+        """
+        Close connection
+        """
+        with self.lock:
+            self.connection.close()
+
+
+class ReportFiles():
+    """
+    Least recently used cache of open report file handles
+    """
+
+    def __init__(self, location, max_handles=32, mmap_size=256 * 1024 * 1024, check_interval=5):
+        self.location = location
+        self.max_handles = max(1, max_handles)
+        self.mmap_size = mmap_size
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.handles = OrderedDict()
+
+    def get_report(self, relmon):
+        """
+        Return open report file of a RelMon or None if there is no such file
+        """
+        with self.lock:
+            report = self.handles.get(relmon)
+            if report is not None:
+                if not report.is_replaced(self.check_interval):
+                    self.handles.move_to_end(relmon)
+                    return report
+
+                logging.info('Report %s was replaced, reopening it', relmon)
+                del self.handles[relmon]
+                report.close()
+
+            file_path = os.path.join(self.location, '%s.sqlite' % (relmon))
+            try:
+                report = ReportFile(file_path, self.mmap_size)
+            except (OSError, sqlite3.Error) as ex:
+                logging.warning('Could not open report %s: %s', file_path, ex)
+                return None
+
+            self.handles[relmon] = report
+            while len(self.handles) > self.max_handles:
+                _, evicted_report = self.handles.popitem(last=False)
+                evicted_report.close()
+
+            return report
+
+    def get_file(self, relmon, category, path):
+        """
+        Return gzip compressed content of a file in RelMon report or None
+        If handle got closed by another thread in the meantime, try again
+        """
+        for _ in range(2):
+            report = self.get_report(relmon)
+            if report is None:
+                return None
+
+            try:
+                return report.get_file(category, path)
+            except sqlite3.ProgrammingError as ex:
+                logging.info('Report %s handle was closed: %s', relmon, ex)
+
+        return None
+
+
+def get_report_or_404(relmon, category):
+    """
+    Return report of a RelMon if names are safe and it exists
+    """
+    if not re.match(r'^[A-Za-z0-9_\-]+$', relmon) or not re.match(r'^[A-Za-z0-9_]+$', category):
+        return None
+
+    return current_app.config['REPORT_FILES'].get_report(relmon)
+
+
+@report_blueprint.route('/<relmon>/<category>/<path:file_path>')
+def get_latest_file(relmon, category, file_path):
+    """
+    Redirect to URL of a file in the current build of a report
+    Relative links in report pages keep the build in URL
+    """
+    report = get_report_or_404(relmon, category)
+    if report is None:
+        return make_response('Report not found', 404)
+
+    return redirect(url_for('reports.get_file',
+                            relmon=relmon,
+                            build=report.build,
+                            category=category,
+                            file_path=file_path))
+
+
+@report_blueprint.route('/<relmon>/build-<build>/<category>/<path:file_path>')
+def get_file(relmon, build, category, file_path):
+    """
+    Return gzip compressed file of a report build as it is stored in report file
+    Content of a build never changes, so it can be cached forever
+    """
+    report = get_report_or_404(relmon, category)
+    if report is None:
+        return make_response('Report not found', 404)
+
+    if build != report.build:
+        # Link to an older build
+        return redirect(url_for('reports.get_file',
+                                relmon=relmon,
+                                build=report.build,
+                                category=category,
+                                file_path=file_path))
+
+    etag = '"%s-%s"' % (build, hashlib.sha1(file_path.encode('utf-8')).hexdigest()[:16])
+    headers = {'ETag': etag,
+               'Cache-Control': 'public, max-age=31536000, immutable'}
+    if etag in request.headers.get('If-None-Match', ''):
+        return make_response('', 304, headers)
+
+    content = current_app.config['REPORT_FILES'].get_file(relmon, category, file_path)
+    if content is None:
+        return make_response('File not found', 404)
+
+    response = make_response(content)
+    response.headers.extend(headers)
+    response.headers['Content-Type'] = (mimetypes.guess_type(file_path)[0]
+                                        or 'application/octet-stream')
+    # Content is stored compressed, so it is sent without re-encoding
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,81 @@
+"""
+Benchmark of SSHExecutor command execution against the previous polling one
+Runs the same commands on submission host with both and prints latency
+Usage: python3 -m local.ssh_benchmark --mode dev
+"""
+import argparse
+import configparser
+import time
+from local.ssh_executor import SSHExecutor
+
+
+# Commands of different output sizes
+COMMANDS = [('empty', 'true'),
+            ('rm', 'rm -rf /tmp/relmon_ssh_benchmark_nonexistent'),
+            ('stderr', 'echo error 1>&2'),
+            ('1MB', 'head -c 786432 /dev/zero | base64'),
+            ('16MB', 'head -c 12582912 /dev/zero | base64')]
+
+
+def legacy_execute_command(ssh_client, command):
+    """
+    Previous execute_command: poll for EOF every second, first for stdout
+    and then for stderr
+    """
+    (_, stdout, stderr) = ssh_client.exec_command(command)
+    stdout_timeout = time.time() + 60
+    while not stdout.channel.eof_received:
+        time.sleep(1)
+        if time.time() > stdout_timeout:
+            stdout.channel.close()
+            break
+
+    stdout = stdout.read().decode('utf-8').strip()
+    stderr_timeout = time.time() + 60
+    while not stderr.channel.eof_received:
+        time.sleep(1)
+        if time.time() > stderr_timeout:
+            stderr.channel.close()
+            break
+
+    stderr = stderr.read().decode('utf-8').strip()
+    return stdout, stderr
+
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description='Benchmark of SSH command execution')
+    parser.add_argument('--mode',
+                        choices=['prod', 'dev'],
+                        default='dev',
+                        help='Section of config.cfg with submission host and credentials')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs of each command')
+    args = vars(parser.parse_args())
+    config = configparser.ConfigParser()
+    config.read('config.cfg')
+    ssh_executor = SSHExecutor(dict(config.items(args['mode'])))
+    ssh_client = ssh_executor.get_ssh_client()
+    implementations = (('polling', lambda c: legacy_execute_command(ssh_client, c)),
+                       ('select', ssh_executor.execute_command))
+    print('%-8s %-8s %10s %10s %12s' % ('Command', 'Method', 'Mean s', 'Max s', 'Output MB'))
+    for name, command in COMMANDS:
+        for method, execute in implementations:
+            durations = []
+            for _ in range(args['runs']):
+                start_time = time.time()
+                stdout = execute(command)[0]
+                durations.append(time.time() - start_time)
+
+            print('%-8s %-8s %10.3f %10.3f %12.2f' % (name,
+                                                      method,
+                                                      sum(durations) / len(durations),
+                                                      max(durations),
+                                                      len(stdout) / (1024.0 * 1024.0)))
+
+    ssh_executor.close_connections()
+
+
+if __name__ == '__main__':
+    main()
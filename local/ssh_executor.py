@@ -3,18 +3,26 @@ Module that handles all SSH operations - both ssh and ftp
 """
 import json
 import logging
+import select
+import socket
+import threading
 import time
+from contextlib import contextmanager
 import paramiko
 
 
 class SSHExecutor():
     """
     SSH executor allows to perform remote commands and upload/download files
+    Executor can be used by multiple threads at once, each command and file
+    transfer gets it's own channel over the same SSH connection
     """
 
     def __init__(self, config):
         self.ssh_client = None
-        self.ftp_client = None
+        # SFTP clients that are not used by any thread at the moment
+        self.ftp_clients = []
+        self.lock = threading.RLock()
         self.logger = logging.getLogger('logger')
         self.remote_host = config['submission_host']
         self.credentials = config['ssh_credentials']
@@ -24,9 +32,18 @@ class SSHExecutor():
         Initiate SSH connection and save it as self.ssh_client
         """
         self.logger.info('Will set up ssh')
-        if self.ssh_client:
-            self.close_connections()
+        with self.lock:
+            if self.ssh_client:
+                self.close_connections()
 
+            self.ssh_client = self.__connect()
+
+        self.logger.info('Done setting up ssh')
+
+    def __connect(self):
+        """
+        Load credentials and return connected SSH client
+        """
         if ':' not in self.credentials:
             with open(self.credentials) as json_file:
                 credentials = json.load(json_file)
@@ -36,61 +53,104 @@ class SSHExecutor():
             credentials['password'] = self.credentials.split(':')[1]
 
         self.logger.info('Credentials loaded successfully: %s', credentials['username'])
-        self.ssh_client = paramiko.SSHClient()
-        self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.ssh_client.connect(self.remote_host,
-                                username=credentials['username'],
-                                password=credentials['password'],
-                                timeout=30)
-        self.logger.info('Done setting up ssh')
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.connect(self.remote_host,
+                           username=credentials['username'],
+                           password=credentials['password'],
+                           timeout=30)
+        return ssh_client
+
+    def get_ssh_client(self):
+        """
+        Return SSH client, connection is set up if there is none
+        """
+        with self.lock:
+            if not self.ssh_client:
+                self.setup_ssh()
+
+            return self.ssh_client
 
     def setup_ftp(self):
         """
-        Initiate SFTP connection and save it as self.ftp_client
+        Open a new SFTP channel and return SFTP client
         If needed, SSH connection will be automatically set up
         """
         self.logger.info('Will set up ftp')
-        if self.ftp_client:
-            self.close_connections()
+        ftp_client = self.get_ssh_client().open_sftp()
+        self.logger.info('Done setting up ftp')
+        return ftp_client
+
+    @contextmanager
+    def ftp_client(self):
+        """
+        Take an idle SFTP client or open a new one and give it back when done
+        Each thread uses it's own SFTP channel
+        """
+        with self.lock:
+            ftp_client = self.ftp_clients.pop() if self.ftp_clients else None
 
-        if not self.ssh_client:
-            self.setup_ssh()
+        if not ftp_client:
+            ftp_client = self.setup_ftp()
 
-        self.ftp_client = self.ssh_client.open_sftp()
-        self.logger.info('Done setting up ftp')
+        try:
+            yield ftp_client
+        except Exception:
+            # Client might be broken, so it is not reused
+            ftp_client.close()
+            raise
+
+        with self.lock:
+            self.ftp_clients.append(ftp_client)
 
-    def execute_command(self, command):
+    def execute_command(self, command, timeout=60):
         """
         Execute command over SSH
+        Stdout and stderr are read as they arrive, so large outputs do not
+        block the command, and reading stops as soon as channel is closed
+        Return stdout, stderr and exit code, exit code is -1 on timeout
         """
-        if not self.ssh_client:
-            self.setup_ssh()
-
         if isinstance(command, list):
             command = '; '.join(command)
 
         self.logger.info('Executing %s', command)
-        (_, stdout, stderr) = self.ssh_client.exec_command(command)
-        self.logger.info('Executed %s. Reading response', command)
-        # Close channel after minute of waiting for EOF
-        # This timeouts and closes channel if nothing was received
-        stdout_timeout = time.time() + 60
-        while not stdout.channel.eof_received:
-            time.sleep(1)
-            if time.time() > stdout_timeout:
-                stdout.channel.close()
-                break
-
-        stdout = stdout.read().decode('utf-8').strip()
-        # Same thing for stderr
-        stderr_timeout = time.time() + 60
-        while not stderr.channel.eof_received:
-            time.sleep(1)
-            if time.time() > stderr_timeout:
-                stderr.channel.close()
-                break
-
-        stderr = stderr.read().decode('utf-8').strip()
+        channel = self.get_ssh_client().get_transport().open_session()
+        channel.exec_command(command)
+        channel.shutdown_write()
+        stdout = []
+        stderr = []
+        deadline = time.time() + timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                # Channel becomes readable when there is stdout or stderr data or EOF
+                select.select([channel], [], [], remaining)
+                # No data comes after EOF, so everything is read if EOF was there before
+                eof_received = channel.eof_received
+                while channel.recv_ready():
+                    stdout.append(channel.recv(65536))
+
+                while channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(65536))
+
+                if eof_received:
+                    break
+
+            # Exit status is sent after EOF
+            if channel.status_event.wait(max(0, deadline - time.time())):
+                exit_code = channel.recv_exit_status()
+            else:
+                self.logger.error('Command timed out after %ss: %s', timeout, command)
+                exit_code = -1
+
+        finally:
+            channel.close()
+
+        stdout = b''.join(stdout).decode('utf-8', 'replace').strip()
+        stderr = b''.join(stderr).decode('utf-8', 'replace').strip()
         # Read output from stdout and stderr streams
         if stdout:
             self.logger.info('STDOUT (%s): %s', command, stdout)
@@ -98,18 +158,59 @@ class SSHExecutor():
         if stderr:
             self.logger.error('STDERR (%s): %s', command, stderr)
 
-        return stdout, stderr
+        if exit_code != 0:
+            self.logger.error('Exit code (%s): %s', command, exit_code)
+
+        return stdout, stderr, exit_code
+
+    def stream_command(self, command, idle_timeout=1):
+        """
+        Execute long running command over SSH on a separate channel and yield
+        lines of it's output as they arrive
+        None is yielded after each idle timeout without output, so caller can
+        stop by closing the generator
+        """
+        transport = self.get_ssh_client().get_transport()
+        # Keep long lived connection alive through firewalls
+        transport.set_keepalive(60)
+        channel = transport.open_session()
+        channel.settimeout(idle_timeout)
+        self.logger.info('Streaming %s', command)
+        channel.exec_command(command)
+        buffer = b''
+        try:
+            while True:
+                try:
+                    data = channel.recv(65536)
+                except socket.timeout:
+                    yield None
+                    continue
+
+                if not data:
+                    break
+
+                buffer += data
+                lines = buffer.split(b'\n')
+                buffer = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8', 'replace')
+
+            if buffer:
+                yield buffer.decode('utf-8', 'replace')
+
+        finally:
+            channel.close()
+            self.logger.info('Stopped streaming %s', command)
 
     def upload_file(self, copy_from, copy_to):
         """
         Upload a file
         """
         self.logger.info('Will upload file %s to %s', copy_from, copy_to)
-        if not self.ftp_client:
-            self.setup_ftp()
-
         try:
-            self.ftp_client.put(copy_from, copy_to)
+            with self.ftp_client() as ftp_client:
+                ftp_client.put(copy_from, copy_to)
+
             self.logger.info('Uploaded file to %s', copy_to)
         except Exception as ex:
             self.logger.error('Error uploading file from %s to %s. %s', copy_from, copy_to, ex)
@@ -119,11 +220,10 @@ class SSHExecutor():
         Download file from remote host
         """
         self.logger.info('Will download file %s to %s', copy_from, copy_to)
-        if not self.ftp_client:
-            self.setup_ftp()
-
         try:
-            self.ftp_client.get(copy_from, copy_to)
+            with self.ftp_client() as ftp_client:
+                ftp_client.get(copy_from, copy_to)
+
             self.logger.info('Downloaded file to %s', copy_to)
         except Exception as ex:
             self.logger.error('Error downloading file from %s to %s. %s', copy_from, copy_to, ex)
@@ -132,14 +232,17 @@ class SSHExecutor():
         """
         Close any active connections
         """
-        if self.ftp_client:
-            self.logger.info('Closing ftp client')
-            self.ftp_client.close()
-            self.ftp_client = None
-            self.logger.info('Closed ftp client')
-
-        if self.ssh_client:
-            self.logger.info('Closing ssh client')
-            self.ssh_client.close()
-            self.ssh_client = None
-            self.logger.info('Closed ssh client')
+        with self.lock:
+            if self.ftp_clients:
+                self.logger.info('Closing %s ftp clients', len(self.ftp_clients))
+                for ftp_client in self.ftp_clients:
+                    ftp_client.close()
+
+                self.ftp_clients = []
+                self.logger.info('Closed ftp clients')
+
+            if self.ssh_client:
+                self.logger.info('Closing ssh client')
+                self.ssh_client.close()
+                self.ssh_client = None
+                self.logger.info('Closed ssh client')
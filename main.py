@@ -12,17 +12,22 @@ from flask import Flask, render_template, request, make_response
 from flask_restful import Api
 from jinja2.exceptions import TemplateNotFound
 from apscheduler.schedulers.background import BackgroundScheduler
+from pymongo.errors import OperationFailure
 from mongodb_database import Database
 from local.controller import Controller
+from local.condor_event_watcher import CondorEventWatcher
 from local.relmon import RelMon
+from local.report_server import report_blueprint, ReportFiles
 
 
 app = Flask(__name__,
             static_folder="./frontend/dist/static",
             template_folder="./frontend/dist")
 api = Api(app)
+app.register_blueprint(report_blueprint, url_prefix='/reports')
 scheduler = BackgroundScheduler()
 controller = None
+condor_event_watcher = None
 
 
 @app.route('/')
@@ -110,71 +115,67 @@ def get_relmons():
 
     page = int(args.get('page', 0))
     limit = int(args.get('limit', database.PAGE_SIZE))
+    cursor = args.get('cursor')
+    count = args.get('count', 'cached')
+    if count not in ('exact', 'estimated', 'cached'):
+        return output_text({'message': 'Count must be exact, estimated or cached'}, code=400)
+
     query = args.get('q')
-    if query:
-        query = query.strip()
-        if query.lower() in ('new', 'submitted', 'running', 'finishing', 'done', 'failed'):
-            query_dict = {'status': query.lower()}
-            data, total_rows = database.get_relmons(query_dict=query_dict,
-                                                    page=page,
-                                                    page_size=limit)
+    try:
+        if query:
+            query = query.strip()
+            if query.lower() in ('new', 'submitted', 'running', 'finishing', 'done', 'failed'):
+                query_dict = {'status': query.lower()}
+                data, total_rows, next_cursor = database.get_relmons(query_dict=query_dict,
+                                                                     page=page,
+                                                                     page_size=limit,
+                                                                     cursor=cursor,
+                                                                     count=count)
+            else:
+                query_dict = {'_id': query}
+                data, total_rows, next_cursor = database.get_relmons(query_dict=query_dict,
+                                                                     page=page,
+                                                                     page_size=limit,
+                                                                     cursor=cursor)
+                if total_rows == 0:
+                    # Perform case insensitive search
+                    query_dict = database.get_name_search_query(query)
+                    data, total_rows, next_cursor = database.get_relmons(query_dict=query_dict,
+                                                                         page=page,
+                                                                         page_size=limit,
+                                                                         cursor=cursor,
+                                                                         count=count)
         else:
-            query_dict = {'_id': query}
-            data, total_rows = database.get_relmons(query_dict=query_dict,
-                                                    page=page,
-                                                    page_size=limit)
-            if total_rows == 0:
-                query = '*%s*' % (query)
-                # Perform case insensitive search
-                query_dict = {'name': {'$regex': query.replace('*', '.*'), '$options': '-i'}}
-                data, total_rows = database.get_relmons(query_dict=query_dict,
-                                                        page=page,
-                                                        page_size=limit)
-    else:
-        data, total_rows = database.get_relmons(page=page, page_size=limit)
-
-    for relmon in data:
-        if 'user_info' in relmon:
-            del relmon['user_info']
-
-        relmon['total_relvals'] = 0
-        relmon['downloaded_relvals'] = 0
-        relmon['compared_relvals'] = 0
-        for category in relmon.get('categories'):
-            relmon['total_relvals'] += len(category['reference']) + len(category['target'])
-            category['reference_status'] = {}
-            category['reference_size'] = 0
-            for relval in category['reference']:
-                category['reference_size'] += relval.get('file_size', 0)
-                relmon_status = relval['status']
-                if relmon_status not in category['reference_status']:
-                    category['reference_status'][relmon_status] = 0
-
-                if relmon_status != 'initial':
-                    relmon['downloaded_relvals'] += + 1
-
-                if category['status'] == 'done':
-                    relmon['compared_relvals'] += 1
-
-                category['reference_status'][relmon_status] += 1
-
-            category['target_status'] = {}
-            category['target_size'] = 0
-            for relval in category['target']:
-                category['target_size'] += relval.get('file_size', 0)
-                relmon_status = relval['status']
-                if relmon_status not in category['target_status']:
-                    category['target_status'][relmon_status] = 0
-
-                if relmon_status != 'initial':
-                    relmon['downloaded_relvals'] = relmon['downloaded_relvals'] + 1
-
-                if category['status'] == 'done':
-                    relmon['compared_relvals'] += 1
-
-                category['target_status'][relmon_status] += 1
-
-    return output_text({'data': data, 'total_rows': total_rows, 'page_size': limit})
+            data, total_rows, next_cursor = database.get_relmons(page=page,
+                                                                 page_size=limit,
+                                                                 cursor=cursor,
+                                                                 count=count)
+    except ValueError as ex:
+        return output_text({'message': str(ex)}, code=400)
+
+    return output_text({'data': data,
+                        'total_rows': total_rows,
+                        'page_size': limit,
+                        'next_cursor': next_cursor})
+
+
+@app.route('/api/get_relmon')
+def get_relmon():
+    """
+    API to fetch a single RelMon with all references and targets
+    """
+    relmon_id = request.args.get('id')
+    if not relmon_id:
+        return output_text({'message': 'No ID'}, code=400)
+
+    database = Database()
+    relmon = database.get_relmon(relmon_id)
+    if not relmon:
+        return output_text({'message': 'RelMon does not exist'}, code=404)
+
+    relmon.pop('user_info', None)
+    relmon.pop('name_suffixes', None)
+    return output_text(relmon)
 
 
 def output_text(data, code=200, headers=None):
@@ -227,6 +228,34 @@ def update_info():
 
     data = json.loads(request.data.decode('utf-8'))
     database = Database()
+    if 'sequence' in data:
+        # Partial update with only changed fields
+        try:
+            applied = database.apply_relmon_changes(data['id'],
+                                                    int(data['sequence']),
+                                                    data.get('status'),
+                                                    data.get('changes', []))
+        except (KeyError, ValueError, OperationFailure) as ex:
+            # For example, conflicting array filters of relvals with same names
+            logger.error('Bad update for %s: %s', data.get('id'), ex)
+            return output_text({'message': 'Bad update: %s' % (ex)}, code=400)
+
+        if not applied:
+            logger.info('Update %s for %s is outdated or RelMon does not exist',
+                        data['sequence'],
+                        data['id'])
+            return output_text({'message': 'Outdated'}, code=409)
+
+        logger.info('Update %s for %s: %s changes. Status %s',
+                    data['sequence'],
+                    data['id'],
+                    len(data.get('changes', [])),
+                    data.get('status', 'unchanged'))
+        if data.get('status'):
+            tick_now()
+
+        return output_text({'message': 'OK'})
+
     relmon = database.get_relmon(data['id'])
     if not relmon:
         return output_text({'message': 'Could not find'})
@@ -237,8 +266,7 @@ def update_info():
     logger.info('Update for %s (%s). Status is %s', relmon['name'], relmon['id'], relmon['status'])
     database.update_relmon(RelMon(relmon))
     if relmon['status'] != old_status:
-        for job in scheduler.get_jobs():
-            job.modify(next_run_time=datetime.now())
+        tick_now()
 
     return output_text({'message': 'OK'})
 
@@ -251,12 +279,22 @@ def controller_tick():
     if not is_user_authorized():
         return output_text({'message': 'Unauthorized'}, code=403)
 
-    for job in scheduler.get_jobs():
-        job.modify(next_run_time=datetime.now())
+    tick_now()
 
     return output_text({'message': 'OK'})
 
 
+@app.route('/api/database_stats')
+def database_stats():
+    """
+    API for database connection pool statistics of web server process
+    """
+    if not is_user_authorized():
+        return output_text({'message': 'Unauthorized'}, code=403)
+
+    return output_text(Database.get_pool_statistics())
+
+
 @app.route('/api/user')
 def user_info():
     """
@@ -294,6 +332,14 @@ def tick():
     controller.tick()
 
 
+def tick_now():
+    """
+    Move next scheduled tick to now
+    """
+    for job in scheduler.get_jobs():
+        job.modify(next_run_time=datetime.now())
+
+
 def setup_console_logging():
     """
     Setup logging to console
@@ -352,12 +398,30 @@ def main():
                           'interval',
                           seconds=int(config.get('tick_interval')),
                           max_instances=1)
+        # Job events trigger ticks right away, periodic ticks are a fallback
+        if config.get('condor_events', '').lower() == 'true':
+            global condor_event_watcher
+            condor_event_watcher = CondorEventWatcher(config, tick_now)
 
     database_auth = config.get('database_auth')
     if database_auth:
         Database.set_credentials_file(database_auth)
 
+    Database.set_pool_options(config)
+    # Reports are served from the same directory where jobs put them
+    app.config['REPORT_FILES'] = ReportFiles(config.get('reports_location',
+                                                        config.get('web_location')),
+                                             int(config.get('reports_max_handles', 32)))
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        database = Database()
+        database.ensure_indexes()
+        database.fill_missing_summaries()
+        database.check_query_plans()
+
     scheduler.start()
+    if condor_event_watcher:
+        condor_event_watcher.start()
+
     port = args.get('port')
     host = args.get('host')
     logger.info('Will run on %s:%s', host, port)
@@ -365,6 +429,9 @@ def main():
             port=port,
             debug=debug,
             threaded=True)
+    if condor_event_watcher:
+        condor_event_watcher.stop()
+
     scheduler.shutdown()
 
 
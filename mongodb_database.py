@@ -5,8 +5,105 @@ import logging
 import time
 import json
 import os
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+import base64
+import re
+import threading
+from pymongo import MongoClient, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
+from local.relmon import RelMon
+
+
+class PoolStatistics(ConnectionPoolListener):
+    """
+    Connection pool listener that counts checkouts, wait time and open sockets
+    of the shared MongoClient
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {'checkouts': 0,
+                      'checkout_failures': 0,
+                      'checked_out': 0,
+                      'max_checked_out': 0,
+                      'open_sockets': 0,
+                      'max_open_sockets': 0,
+                      'created_sockets': 0,
+                      'closed_sockets': 0,
+                      'total_wait_time': 0.0,
+                      'max_wait_time': 0.0,
+                      'pool_clears': 0}
+
+    def __checkout_wait_time(self):
+        """
+        Return seconds passed since checkout started in this thread
+        """
+        start = getattr(self.local, 'checkout_start', None)
+        self.local.checkout_start = None
+        if start is None:
+            return 0.0
+
+        return time.time() - start
+
+    def get_statistics(self):
+        """
+        Return a copy of current statistics with average wait time
+        """
+        with self.lock:
+            stats = dict(self.stats)
+
+        checkouts = max(stats['checkouts'], 1)
+        stats['average_wait_time'] = stats['total_wait_time'] / checkouts
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.stats['pool_clears'] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.stats['created_sockets'] += 1
+            self.stats['open_sockets'] += 1
+            self.stats['max_open_sockets'] = max(self.stats['max_open_sockets'],
+                                                 self.stats['open_sockets'])
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.stats['closed_sockets'] += 1
+            self.stats['open_sockets'] -= 1
+
+    def connection_check_out_started(self, event):
+        self.local.checkout_start = time.time()
+
+    def connection_check_out_failed(self, event):
+        wait_time = self.__checkout_wait_time()
+        with self.lock:
+            self.stats['checkout_failures'] += 1
+            self.stats['total_wait_time'] += wait_time
+
+    def connection_checked_out(self, event):
+        wait_time = self.__checkout_wait_time()
+        with self.lock:
+            self.stats['checkouts'] += 1
+            self.stats['checked_out'] += 1
+            self.stats['max_checked_out'] = max(self.stats['max_checked_out'],
+                                                self.stats['checked_out'])
+            self.stats['total_wait_time'] += wait_time
+            self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.stats['checked_out'] -= 1
 
 
 class Database:
@@ -15,31 +112,132 @@ class Database:
     It encapsulates underlying connection and exposes some convenience methods
     """
     PAGE_SIZE = 10
+    # Fields that are not needed to show list of RelMons
+    SUMMARY_PROJECTION = {'categories.reference': 0,
+                          'categories.target': 0,
+                          'user_info': 0,
+                          'name_suffixes': 0}
     __DATABASE_HOST = 'localhost'
     __DATABASE_PORT = 27017
     __DATABASE_NAME = 'relmons'
     __COLLECTION_NAME = 'relmons'
     __USERNAME = None
     __PASSWORD = None
+    # Options of the shared client connection pool
+    __POOL_OPTIONS = {'maxPoolSize': 20,
+                      'minPoolSize': 0,
+                      'maxIdleTimeMS': 60000,
+                      'waitQueueTimeoutMS': 10000,
+                      'connectTimeoutMS': 5000,
+                      'serverSelectionTimeoutMS': 5000}
+    # One client per process, created lazily and shared by all Database objects
+    __CLIENT = None
+    __CLIENT_PID = None
+    __CLIENT_LOCK = threading.Lock()
+    __POOL_STATISTICS = None
+    # Counts of search results, used when exact count is not necessary
+    __COUNT_CACHE = {}
+    __COUNT_CACHE_TTL = 30
+    # Maximum number of cached counts, queries come from users, so there might be many
+    __COUNT_CACHE_SIZE = 256
+    __COUNT_CACHE_LOCK = threading.Lock()
+    # Fields that can be changed by partial progress updates
+    __CATEGORY_FIELDS = ('status', 'hlt_status', 'no_hlt_status')
+    __RELVAL_FIELDS = ('file_name', 'file_url', 'file_size', 'status', 'events', 'match')
+    # Secondary indexes of relmons collection: name, keys and options
+    __INDEXES = [('status', [('status', ASCENDING)], {}),
+                 ('condor_status', [('condor_status', ASCENDING)], {}),
+                 ('name', [('name', ASCENDING)], {'unique': True}),
+                 ('last_update', [('last_update', DESCENDING)], {}),
+                 ('name_suffixes', [('name_suffixes', ASCENDING)], {})]
 
     def __init__(self):
         self.logger = logging.getLogger('logger')
-        db_host = os.environ.get('DB_HOST', Database.__DATABASE_HOST)
-        db_port = os.environ.get('DB_PORT', Database.__DATABASE_PORT)
-        if Database.__USERNAME and Database.__PASSWORD:
-            self.logger.debug('Using DB with username and password')
-            self.client = MongoClient(db_host,
-                                      db_port,
-                                      username=Database.__USERNAME,
-                                      password=Database.__PASSWORD,
-                                      authSource='admin',
-                                      authMechanism='SCRAM-SHA-256')[Database.__DATABASE_NAME]
-        else:
-            self.logger.debug('Using DB without username and password')
-            self.client = MongoClient(db_host, db_port)[Database.__DATABASE_NAME]
-
+        self.client = Database.get_client()[Database.__DATABASE_NAME]
         self.relmons = self.client[self.__COLLECTION_NAME]
 
+    @classmethod
+    def get_client(cls):
+        """
+        Return MongoClient shared by the whole process
+        Client is created on first use and recreated after a fork, because
+        MongoClient must not be shared between processes
+        """
+        pid = os.getpid()
+        if cls.__CLIENT is not None and cls.__CLIENT_PID == pid:
+            return cls.__CLIENT
+
+        with cls.__CLIENT_LOCK:
+            if cls.__CLIENT is not None and cls.__CLIENT_PID == pid:
+                return cls.__CLIENT
+
+            logger = logging.getLogger('logger')
+            db_host = os.environ.get('DB_HOST', Database.__DATABASE_HOST)
+            db_port = int(os.environ.get('DB_PORT', Database.__DATABASE_PORT))
+            statistics = PoolStatistics()
+            options = dict(cls.__POOL_OPTIONS)
+            options['event_listeners'] = [statistics]
+            if cls.__USERNAME and cls.__PASSWORD:
+                logger.debug('Using DB with username and password')
+                options['username'] = cls.__USERNAME
+                options['password'] = cls.__PASSWORD
+                options['authSource'] = 'admin'
+                options['authMechanism'] = 'SCRAM-SHA-256'
+            else:
+                logger.debug('Using DB without username and password')
+
+            logger.info('Creating database client in process %s, pool options: %s',
+                        pid,
+                        cls.__POOL_OPTIONS)
+            cls.__CLIENT = MongoClient(db_host, db_port, **options)
+            cls.__CLIENT_PID = pid
+            cls.__POOL_STATISTICS = statistics
+
+        return cls.__CLIENT
+
+    @classmethod
+    def close_client(cls):
+        """
+        Close shared client of this process and all it's pooled sockets
+        """
+        with cls.__CLIENT_LOCK:
+            if cls.__CLIENT is not None and cls.__CLIENT_PID == os.getpid():
+                cls.__CLIENT.close()
+
+            cls.__CLIENT = None
+            cls.__CLIENT_PID = None
+
+    @classmethod
+    def set_pool_options(cls, config):
+        """
+        Set connection pool options from config dictionary
+        Keys that are not in config keep their default values
+        """
+        config_keys = {'database_max_pool_size': 'maxPoolSize',
+                       'database_min_pool_size': 'minPoolSize',
+                       'database_max_idle_time': 'maxIdleTimeMS',
+                       'database_wait_queue_timeout': 'waitQueueTimeoutMS',
+                       'database_connect_timeout': 'connectTimeoutMS',
+                       'database_server_selection_timeout': 'serverSelectionTimeoutMS'}
+        for config_key, option_name in config_keys.items():
+            if config.get(config_key):
+                cls.__POOL_OPTIONS[option_name] = int(config[config_key])
+
+    @classmethod
+    def get_pool_statistics(cls):
+        """
+        Return connection pool statistics of this process
+        Wait times are in seconds
+        """
+        statistics = cls.__POOL_STATISTICS
+        if statistics is None or cls.__CLIENT_PID != os.getpid():
+            return {}
+
+        stats = statistics.get_statistics()
+        stats['pid'] = cls.__CLIENT_PID
+        stats['max_pool_size'] = cls.__POOL_OPTIONS['maxPoolSize']
+        return stats
+
     @classmethod
     def set_credentials(cls, username, password):
         """
@@ -58,38 +256,247 @@ class Database:
 
         cls.set_credentials(credentials['username'], credentials['password'])
 
+    @staticmethod
+    def get_name_suffixes(name):
+        """
+        Return all lowercase suffixes of a RelMon name
+        Substring search becomes an anchored prefix search over these suffixes
+        which can use an index, unlike unanchored case insensitive regex
+        """
+        name = name.lower()
+        return [name[i:] for i in range(len(name))]
+
+    @staticmethod
+    def get_name_search_query(query):
+        """
+        Return query dictionary for case insensitive substring search by name
+        Asterisks in the query are treated as wildcards
+        """
+        query = query.lower().strip('*')
+        parts = [part for part in query.split('*') if part]
+        if not parts:
+            return {}
+
+        # Longest part is the most selective prefix for the suffixes index
+        longest_part = max(parts, key=len)
+        query_dict = {'name_suffixes': {'$regex': '^%s' % (re.escape(longest_part))}}
+        if len(parts) > 1:
+            pattern = '.*'.join(re.escape(part) for part in parts)
+            query_dict['name'] = {'$regex': pattern, '$options': 'i'}
+
+        return query_dict
+
+    def ensure_indexes(self):
+        """
+        Create secondary indexes of relmons collection if they do not exist
+        and fill name suffixes of RelMons that were saved without them
+        """
+        existing_indexes = self.relmons.index_information()
+        for index_name, keys, options in self.__INDEXES:
+            if index_name in existing_indexes:
+                if existing_indexes[index_name]['key'] != keys:
+                    self.logger.warning('Index %s keys are %s, expected %s',
+                                        index_name,
+                                        existing_indexes[index_name]['key'],
+                                        keys)
+
+                continue
+
+            self.logger.info('Creating index %s on %s', index_name, keys)
+            try:
+                self.relmons.create_index(keys, name=index_name, background=True, **options)
+            except OperationFailure as ex:
+                self.logger.error('Could not create index %s: %s', index_name, ex)
+
+        missing_suffixes = self.relmons.find({'name_suffixes': {'$exists': False}},
+                                             {'name': 1})
+        for relmon in missing_suffixes:
+            self.logger.info('Adding name suffixes to %s', relmon['_id'])
+            name_suffixes = self.get_name_suffixes(relmon['name'])
+            self.relmons.update_one({'_id': relmon['_id']},
+                                    {'$set': {'name_suffixes': name_suffixes}})
+
+    def fill_missing_summaries(self):
+        """
+        Add progress summary to RelMons that were saved without it
+        """
+        for relmon_json in self.relmons.find({'total_relvals': {'$exists': False}}):
+            self.logger.info('Adding progress summary to %s', relmon_json['_id'])
+            relmon_json = RelMon(relmon_json).update_summary()
+            summary_keys = ('categories', 'total_relvals', 'downloaded_relvals', 'compared_relvals')
+            summary = {key: relmon_json[key] for key in summary_keys}
+            self.relmons.update_one({'_id': relmon_json['_id']}, {'$set': summary})
+
+    def check_query_plans(self):
+        """
+        Explain frequent queries and log the ones that do a full collection scan
+        Return list of query descriptions that do a COLLSCAN
+        """
+        queries = [('status', {'status': 'new'}, None),
+                   ('condor_status', {'condor_status': 'RUN'}, None),
+                   ('name', {'name': 'RelMon'}, None),
+                   ('name search', self.get_name_search_query('relmon'), None),
+                   ('last update', {}, [('last_update', DESCENDING)]),
+                   ('all', {}, [('_id', DESCENDING)])]
+        collection_scans = []
+        for description, query_dict, sort in queries:
+            cursor = self.relmons.find(query_dict)
+            if sort:
+                cursor = cursor.sort(sort)
+
+            winning_plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+            stages = []
+            plan = winning_plan
+            while plan:
+                stages.append(plan.get('stage'))
+                plan = plan.get('inputStage')
+
+            if 'COLLSCAN' in stages:
+                self.logger.warning('Query "%s" %s does a COLLSCAN: %s',
+                                    description,
+                                    query_dict,
+                                    ' <- '.join(stages))
+                collection_scans.append(description)
+            else:
+                self.logger.info('Query "%s" plan: %s', description, ' <- '.join(stages))
+
+        return collection_scans
+
     def create_relmon(self, relmon):
         """
         Add given RelMon to the database
         """
-        relmon_json = relmon.get_json()
+        relmon_json = relmon.update_summary()
         relmon_json['last_update'] = int(time.time())
         relmon_json['_id'] = relmon_json['id']
+        relmon_json['name_suffixes'] = self.get_name_suffixes(relmon_json['name'])
         try:
-            return self.relmons.insert_one(relmon_json)
+            result = self.relmons.insert_one(relmon_json)
+            Database.__COUNT_CACHE.clear()
+            return result
         except DuplicateKeyError:
             return None
 
     def update_relmon(self, relmon):
         """
         Update given RelMon in the database based on ID
+        Whole document is replaced, so this should be used only when there is
+        no running job that could send progress updates, use set_relmon_fields
+        otherwise
         """
-        relmon_json = relmon.get_json()
+        relmon_json = relmon.update_summary()
         relmon_json['last_update'] = int(time.time())
         if '_id' not in relmon_json:
             self.logger.error('No _id in document')
             return
 
+        relmon_json['name_suffixes'] = self.get_name_suffixes(relmon_json['name'])
+
         try:
             self.relmons.replace_one({'_id': relmon_json['_id']}, relmon_json)
         except DuplicateKeyError:
             return
 
+    def apply_relmon_changes(self, relmon_id, sequence, status=None, changes=None):
+        """
+        Apply partial progress update to a RelMon with targeted $set updates
+        Changes is a list of dictionaries with category name, optional relval
+        type (reference or target) and name and changed fields
+        Update is applied only if it's sequence number is greater than sequence
+        number of last applied update, so late callbacks do not overwrite newer ones
+        Return whether update was applied
+        """
+        update = {'last_sequence': sequence,
+                  'last_update': int(time.time())}
+        if status:
+            update['status'] = status
+
+        array_filters = []
+        for index, change in enumerate(changes or []):
+            category_filter = 'c%s' % (index)
+            array_filters.append({'%s.name' % (category_filter): change['category']})
+            relval_type = change.get('type')
+            if relval_type:
+                if relval_type not in ('reference', 'target'):
+                    raise ValueError('Bad relval type %s' % (relval_type))
+
+                relval_filter = 'r%s' % (index)
+                array_filters.append({'%s.name' % (relval_filter): change['name']})
+                path = 'categories.$[%s].%s.$[%s]' % (category_filter,
+                                                      relval_type,
+                                                      relval_filter)
+                allowed_fields = self.__RELVAL_FIELDS
+            else:
+                path = 'categories.$[%s]' % (category_filter)
+                allowed_fields = self.__CATEGORY_FIELDS
+
+            for field, value in change['fields'].items():
+                if field not in allowed_fields:
+                    raise ValueError('Field %s cannot be updated' % (field))
+
+                update['%s.%s' % (path, field)] = value
+
+        relmon_json = self.relmons.find_one_and_update(
+            {'_id': relmon_id, 'last_sequence': {'$not': {'$gte': sequence}}},
+            {'$set': update},
+            projection={'categories': 1},
+            array_filters=array_filters or None,
+            return_document=ReturnDocument.AFTER
+        )
+        if not relmon_json:
+            return False
+
+        # Refresh summary, unless a newer update was applied in the meantime
+        relmon_json = RelMon.summarize(relmon_json)
+        summary = {key: relmon_json[key] for key in ('total_relvals',
+                                                     'downloaded_relvals',
+                                                     'compared_relvals')}
+        for index, category in enumerate(relmon_json['categories']):
+            for relval_type in ('reference', 'target'):
+                for suffix in ('total', 'status', 'size'):
+                    key = '%s_%s' % (relval_type, suffix)
+                    summary['categories.%s.%s' % (index, key)] = category[key]
+
+        self.relmons.update_one({'_id': relmon_id, 'last_sequence': sequence},
+                                {'$set': summary})
+        return True
+
+    def set_relmon_fields(self, relmon_id, fields, condor_id=None):
+        """
+        Set only given top level fields of a RelMon with a targeted $set, so
+        categories that are written by progress updates are not overwritten
+        If condor id is given, fields are set only if RelMon still has this job
+        Return whether RelMon was found
+        """
+        update = dict(fields)
+        update['last_update'] = int(time.time())
+        if 'name' in update:
+            update['name_suffixes'] = self.get_name_suffixes(update['name'])
+
+        query = {'_id': relmon_id}
+        if condor_id is not None:
+            query['condor_id'] = condor_id
+
+        return self.relmons.update_one(query, {'$set': update}).matched_count > 0
+
+    def set_condor_status(self, relmon_id, condor_id, condor_status):
+        """
+        Set HTCondor status of a RelMon if it is still tracking given job
+        Return whether status was changed
+        """
+        result = self.relmons.update_one({'_id': relmon_id,
+                                          'condor_id': condor_id,
+                                          'condor_status': {'$ne': condor_status}},
+                                         {'$set': {'condor_status': condor_status,
+                                                   'last_update': int(time.time())}})
+        return result.modified_count > 0
+
     def delete_relmon(self, relmon):
         """
         Delete given RelMon from the database based on it's ID
         """
         self.relmons.delete_one({'_id': relmon.get_id()})
+        Database.__COUNT_CACHE.clear()
 
     def get_relmon_count(self):
         """
@@ -103,18 +510,95 @@ class Database:
         """
         return self.relmons.find_one({'_id': relmon_id})
 
-    def get_relmons(self, query_dict=None, page=0, page_size=PAGE_SIZE):
+    def get_relmons(self, query_dict=None, page=0, page_size=PAGE_SIZE, cursor=None, count='exact'):
         """
         Search for relmons in the database
-        Return list of paginated RelMons and total number of search results
+        Return list of paginated RelMon summaries without references and targets,
+        total number of search results and cursor of the next page
+        If cursor is given, page is ignored and results start right after the
+        RelMon that cursor points to, so deep pages cost the same as the first one
+        Count can be "exact", "estimated" or "cached"
         """
         if query_dict is None:
             query_dict = {}
 
-        relmons = self.relmons.find(query_dict).sort('_id', -1)
-        total_rows = relmons.count()
-        relmons = relmons.skip(page * page_size).limit(page_size)
-        return list(relmons), total_rows
+        total_rows = self.count_relmons(query_dict, count)
+        if cursor:
+            cursor_query = {'_id': {'$lt': self.decode_cursor(cursor)}}
+            if query_dict:
+                cursor_query = {'$and': [query_dict, cursor_query]}
+
+            relmons = self.relmons.find(cursor_query, self.SUMMARY_PROJECTION)
+            relmons = relmons.sort('_id', -1).limit(page_size)
+        else:
+            relmons = self.relmons.find(query_dict, self.SUMMARY_PROJECTION)
+            relmons = relmons.sort('_id', -1).skip(page * page_size).limit(page_size)
+
+        relmons = list(relmons)
+        next_cursor = None
+        if len(relmons) == page_size:
+            next_cursor = self.encode_cursor(relmons[-1]['_id'])
+
+        return relmons, total_rows, next_cursor
+
+    @classmethod
+    def __cache_count(cls, cache_key, total_rows):
+        """
+        Store count in cache, expired and, if needed, oldest counts are evicted
+        so cache does not grow above it's size
+        """
+        now = time.time()
+        with cls.__COUNT_CACHE_LOCK:
+            cache = cls.__COUNT_CACHE
+            if cache_key not in cache and len(cache) >= cls.__COUNT_CACHE_SIZE:
+                for key in [k for k, v in cache.items() if v[0] <= now - cls.__COUNT_CACHE_TTL]:
+                    del cache[key]
+
+                while len(cache) >= cls.__COUNT_CACHE_SIZE:
+                    del cache[min(cache, key=lambda k: cache[k][0])]
+
+            cache[cache_key] = (now, total_rows)
+
+    def count_relmons(self, query_dict, count='exact'):
+        """
+        Return number of RelMons matching the query
+        "estimated" uses collection metadata when query is empty
+        "cached" reuses a recent count of the same query in this process
+        """
+        if count == 'estimated' and not query_dict:
+            return self.relmons.estimated_document_count()
+
+        if count in ('cached', 'estimated'):
+            cache_key = json.dumps(query_dict, sort_keys=True)
+            cached_count = Database.__COUNT_CACHE.get(cache_key)
+            if cached_count and cached_count[0] > time.time() - Database.__COUNT_CACHE_TTL:
+                return cached_count[1]
+
+            total_rows = self.relmons.count_documents(query_dict)
+            Database.__cache_count(cache_key, total_rows)
+            return total_rows
+
+        return self.relmons.count_documents(query_dict)
+
+    @staticmethod
+    def encode_cursor(relmon_id):
+        """
+        Make an opaque pagination cursor that points to given RelMon ID
+        """
+        cursor_json = json.dumps({'_id': relmon_id}).encode('utf-8')
+        return base64.urlsafe_b64encode(cursor_json).decode('utf-8')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Return RelMon ID from a pagination cursor
+        Raise ValueError if cursor is malformed
+        """
+        try:
+            cursor_json = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+            return cursor_json['_id']
+        except (TypeError, KeyError, ValueError) as ex:
+            raise ValueError('Invalid cursor %s' % (cursor)) from ex
 
     def get_relmons_with_status(self, status):
         """
@@ -0,0 +1,135 @@
+"""
+Module that contains CMSWebCache
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class CMSWebCache(object):
+    """
+    CMSWebCache is a persistent cache of cmsweb responses stored in SQLite file
+    Each entry has an expiration time, total size of entries is limited and
+    least recently used entries are evicted first
+    File can be shipped to HTCondor jobs, so RelMons of the same release would
+    not have to make same requests again
+    """
+
+    def __init__(self, filename, max_size=256 * 1024 * 1024):
+        self.filename = filename
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        try:
+            self.connection = self.__open()
+        except sqlite3.DatabaseError as ex:
+            # Cache is only an optimization, so a broken file must not stop the job
+            broken_filename = '%s.broken' % (filename)
+            logging.error('Cache %s is broken, moving it to %s: %s',
+                          filename,
+                          broken_filename,
+                          ex)
+            os.rename(filename, broken_filename)
+            self.connection = self.__open()
+
+    def __open(self):
+        """
+        Open cache file, create table and delete expired entries
+        Evict entries if file got too big, for example after merge of caches
+        """
+        connection = sqlite3.connect(self.filename, check_same_thread=False)
+        try:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'key TEXT PRIMARY KEY, '
+                               'value TEXT, '
+                               'expires REAL, '
+                               'last_used REAL, '
+                               'size INTEGER)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache(last_used)')
+            deleted = connection.execute('DELETE FROM cache WHERE expires < ?',
+                                         (time.time(), )).rowcount
+            connection.commit()
+            entries, size = connection.execute('SELECT COUNT(*), '
+                                               'COALESCE(SUM(size), 0) FROM cache').fetchone()
+        except sqlite3.DatabaseError:
+            connection.close()
+            raise
+
+        logging.info('Cache %s has %s entries (%.2fMB), %s expired entries were deleted',
+                     self.filename,
+                     entries,
+                     size / (1024.0 * 1024.0),
+                     deleted)
+        self.connection = connection
+        if size > self.max_size:
+            self.__evict(size - self.max_size)
+            connection.commit()
+
+        return connection
+
+    def get(self, key):
+        """
+        Return cached value or None if it is missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT value, expires FROM cache WHERE key = ?',
+                                          (key, )).fetchone()
+            if row is None:
+                return None
+
+            if row[1] < now:
+                self.connection.execute('DELETE FROM cache WHERE key = ?', (key, ))
+                self.connection.commit()
+                return None
+
+            self.connection.execute('UPDATE cache SET last_used = ? WHERE key = ?', (now, key))
+            self.connection.commit()
+            return row[0]
+
+    def set(self, key, value, ttl):
+        """
+        Store value for ttl seconds and evict least recently used entries
+        if cache got too big
+        """
+        now = time.time()
+        size = len(key) + len(value)
+        if size > self.max_size:
+            logging.info('%s is too big to be cached', key)
+            return
+
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                    (key, value, now + ttl, now, size))
+            total_size = self.connection.execute('SELECT SUM(size) FROM cache').fetchone()[0]
+            if total_size > self.max_size:
+                self.__evict(total_size - self.max_size)
+
+            self.connection.commit()
+
+    def __evict(self, size_to_free):
+        """
+        Delete least recently used entries until given size is freed
+        """
+        evicted = []
+        freed = 0
+        for key, size in self.connection.execute('SELECT key, size FROM cache '
+                                                 'ORDER BY last_used'):
+            if freed >= size_to_free:
+                break
+
+            evicted.append((key, ))
+            freed += size
+
+        self.connection.executemany('DELETE FROM cache WHERE key = ?', evicted)
+        logging.info('Evicted %s entries (%.2fMB) from cache',
+                     len(evicted),
+                     freed / (1024.0 * 1024.0))
+
+    def close(self):
+        """
+        Close cache file
+        """
+        with self.lock:
+            self.connection.close()
@@ -4,38 +4,213 @@ Module that contains CMSWebWrapper
 
 import logging
 import json
+import math
 import os
+import socket
+import ssl
+import threading
 import time
 try:
-    from http.client import HTTPSConnection
+    from http.client import HTTPSConnection, BadStatusLine
 except ImportError:
-    from httplib import HTTPSConnection
+    from httplib import HTTPSConnection, BadStatusLine
+from cmsweb_cache import CMSWebCache
+
+
+# Whether TLS sessions can be passed to new sockets (Python 3.6+)
+SSL_SESSIONS = hasattr(ssl.SSLSocket, 'session')
+
+
+class CMSWebConnection(HTTPSConnection):
+    """
+    HTTPS connection that resumes TLS session of previously made connections,
+    so new connections skip full handshake with certificate authentication
+    """
+
+    def __init__(self, host, port, context, timeout, tls_session):
+        HTTPSConnection.__init__(self, host, port=port, context=context, timeout=timeout)
+        self.tls_session = tls_session
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        if SSL_SESSIONS and self.tls_session.get('session'):
+            self.sock = self._context.wrap_socket(sock,
+                                                  server_hostname=self.host,
+                                                  session=self.tls_session['session'])
+        else:
+            self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+        self.save_session()
+
+    def save_session(self):
+        """
+        Save TLS session of this connection so it could be resumed by new ones
+        With TLS 1.3 session ticket arrives only after handshake, so this should
+        be called again after a response is read
+        """
+        if SSL_SESSIONS and self.sock is not None and self.sock.session:
+            self.tls_session['session'] = self.sock.session
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of idle persistent connections
+    New connections are made when there are no idle ones, only number of
+    idle connections is limited
+    """
+
+    def __init__(self, factory, max_idle=4):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Return a connection and whether it was reused
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+
+        return self.factory(), False
+
+    def put(self, connection):
+        """
+        Return connection to the pool or close it if pool is full
+        """
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+
+        connection.close()
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for connection in idle:
+            connection.close()
 
 
 class CMSWebWrapper():
     """
     CMSWebWrapper handles all communication with cmsweb
     It requires paths to grid user certificate and grid user key files
+    Optional on_success(transferred_bytes) and on_failure() functions are
+    called after each request that was made to cmsweb, e.g. for back-off
     """
 
-    __cache = {}
+    # Time to live of cached responses of paths with given prefixes, in seconds
+    # Workflow metadata does not change, directory listings get new files
+    CACHE_POLICIES = [('/reqmgr2/data/request', 30 * 24 * 3600),
+                      ('/dqm/', 3600),
+                      ('', 3600)]
+    # Size of chunks that are read from responses
+    CHUNK_SIZE = 1024 * 1024 * 8  # 8 megabytes
+    # Files bigger than this are downloaded in segments if segments > 1
+    SEGMENTED_FILE_SIZE = 1024 * 1024 * 1024  # 1 gigabyte
 
-    def __init__(self, cert_file, key_file):
+    def __init__(self,
+                 cert_file,
+                 key_file,
+                 segments=1,
+                 connections=4,
+                 cache_file=None,
+                 on_success=None,
+                 on_failure=None):
         self.cert_file = cert_file
         self.key_file = key_file
+        self.cache = CMSWebCache(cache_file or ':memory:')
+        self.host = 'cmsweb.cern.ch'
+        self.segments = max(1, segments)
+        self.ssl_context = None
+        self.tls_session = {}
+        self.pool = ConnectionPool(self.__make_connection, connections)
+        self.on_success = on_success
+        self.on_failure = on_failure
 
-    def __get_connection(self):
+    def __make_connection(self):
         """
-        Return a HTTPSConnection to cmsweb.cern.ch
+        Return a new HTTPS connection to cmsweb.cern.ch
         """
         if self.cert_file is None or self.key_file is None:
             raise Exception('Missing user certificate or user key')
 
-        return HTTPSConnection('cmsweb.cern.ch',
-                               port=443,
-                               cert_file=self.cert_file,
-                               key_file=self.key_file,
-                               timeout=120)
+        if self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.load_cert_chain(self.cert_file, self.key_file)
+
+        return CMSWebConnection(self.host,
+                                port=443,
+                                context=self.ssl_context,
+                                timeout=120,
+                                tls_session=self.tls_session)
+
+    def __request(self, path, headers):
+        """
+        Make a GET request using a pooled connection
+        If reused connection was closed by the server, retry with another one
+        Return connection and response, connection must be released afterwards
+        """
+        while True:
+            connection, reused = self.pool.get()
+            try:
+                connection.request('GET', path, headers=headers)
+                return connection, connection.getresponse()
+            except (BadStatusLine, socket.error) as ex:
+                connection.close()
+                if not reused:
+                    raise
+
+                logging.info('Reused connection is stale, will reconnect: %s', ex)
+
+    def __release(self, connection, response):
+        """
+        Return connection to the pool if response was read completely
+        and server keeps connection alive, close it otherwise
+        """
+        connection.save_session()
+        if response.isclosed() and not response.will_close:
+            self.pool.put(connection)
+        else:
+            connection.close()
+
+    def __succeeded(self, transferred_bytes):
+        """
+        Report a successful request
+        """
+        if self.on_success:
+            self.on_success(transferred_bytes)
+
+    def __failed(self):
+        """
+        Report a failed request
+        """
+        if self.on_failure:
+            self.on_failure()
+
+    def close(self):
+        """
+        Close all idle connections and cache
+        """
+        self.pool.close()
+        self.cache.close()
+
+    def get_cache_ttl(self, path):
+        """
+        Return for how long response of given path should be cached
+        """
+        for prefix, ttl in self.CACHE_POLICIES:
+            if path.startswith(prefix):
+                return ttl
+
+        return 0
 
     def get(self, path, cache=True):
         """
@@ -43,28 +218,40 @@ class CMSWebWrapper():
         Add Accept: application/json headers
         """
         logging.info('Will try to GET %s', path)
-        if cache and path in self.__cache:
-            logging.info('Found %s response in cache', path)
-            return self.__cache[path]
-
-        connection = self.__get_connection()
-        connection.request('GET', path, headers={'Accept': 'application/json'})
-        response = connection.getresponse()
-        if response.status != 200:
-            logging.error('Problems (%d) with %s: %s', response.status, path, response.read())
-            connection.close()
-            return None
+        if cache:
+            cached_response = self.cache.get(path)
+            if cached_response is not None:
+                logging.info('Found %s response in cache', path)
+                return cached_response
 
-        decoded_response = response.read().decode('utf-8')
+        try:
+            connection, response = self.__request(path, {'Accept': 'application/json'})
+            if response.status != 200:
+                logging.error('Problems (%d) with %s: %s', response.status, path, response.read())
+                self.__release(connection, response)
+                self.__failed()
+                return None
+
+            raw_response = response.read()
+        except Exception:
+            self.__failed()
+            raise
+
+        self.__succeeded(len(raw_response))
+        decoded_response = raw_response.decode('utf-8')
         if cache:
-            self.__cache[path] = decoded_response
+            self.cache.set(path, decoded_response, self.get_cache_ttl(path))
 
-        connection.close()
+        self.__release(connection, response)
         return decoded_response
 
     def get_big_file(self, path, filename=None):
         """
         Download files chunk by chunk
+        File is written to a .part file which is renamed only after it's size
+        matches Content-Length, so truncated files are never taken as complete
+        If .part file exists, download is resumed using HTTP Range request
+        Big files can be downloaded in several parallel segments
         """
         logging.info('Will try to download file %s', path)
         if filename is None:
@@ -72,34 +259,228 @@ class CMSWebWrapper():
             logging.info('Using file name %s for %s', filename, path)
 
         if os.path.isfile(filename):
+            # Nothing is transferred, so neither success nor failure is reported
             logging.info('File %s already exists', filename)
             return filename
 
-        connection = self.__get_connection()
-        connection.request('GET', path)
-        response = connection.getresponse()
-        chunk_size = 1024 * 1024 * 8  # 8 megabytes
+        try:
+            downloaded_size = self.__download_big_file(path, filename)
+        except Exception:
+            self.__failed()
+            raise
+
+        self.__succeeded(downloaded_size)
+        return filename
+
+    def __download_big_file(self, path, filename):
+        """
+        Download file to a .part file, resume it if possible and rename it
+        Return number of bytes that were transferred
+        """
+        part_filename = filename + '.part'
+        segmented_filename = filename + '.segments.part'
+        if os.path.isfile(segmented_filename):
+            # Segments might have been written in any order, so it cannot be resumed
+            os.remove(segmented_filename)
+
+        offset = 0
+        if os.path.isfile(part_filename):
+            offset = os.path.getsize(part_filename)
+            logging.info('Will resume %s from %s bytes', filename, offset)
+
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%s-' % (offset)
+
+        start_time = time.time()
+        connection, response = self.__request(path, headers)
+        if response.status == 206:
+            # Content-Range: bytes 100-999/1000
+            total_size = int(response.getheader('Content-Range').split('/')[-1])
+        elif response.status == 200:
+            if offset:
+                logging.info('Server ignored range request, downloading %s from scratch', filename)
+                offset = 0
+
+            content_length = response.getheader('Content-Length')
+            total_size = int(content_length) if content_length else None
+        else:
+            response.read()
+            self.__release(connection, response)
+            if response.status == 416 and os.path.isfile(part_filename):
+                # Range is not satisfiable, start from scratch next time
+                os.remove(part_filename)
+
+            raise Exception('Error %s downloading %s' % (response.status, path))
+
+        accepts_ranges = response.getheader('Accept-Ranges', '') == 'bytes'
+        released = False
+        try:
+            if (not offset
+                    and self.segments > 1
+                    and accepts_ranges
+                    and total_size
+                    and total_size >= self.SEGMENTED_FILE_SIZE):
+                downloaded_size = self.__download_segments(path,
+                                                           response,
+                                                           segmented_filename,
+                                                           total_size)
+                os.rename(segmented_filename, part_filename)
+            else:
+                downloaded_size = self.__download_response(response,
+                                                           part_filename,
+                                                           offset,
+                                                           total_size)
+                self.__release(connection, response)
+                released = True
+        finally:
+            if not released:
+                connection.close()
+
+        file_size = os.path.getsize(part_filename)
+        if total_size is not None and file_size != total_size:
+            raise Exception('Size of %s is %s, expected %s' % (filename, file_size, total_size))
+
+        os.rename(part_filename, filename)
+        end_time = time.time()
+        speed = (downloaded_size / (1024.0 * 1024.0)) / max(end_time - start_time, 0.001)
+        logging.info('Downloaded %.2fMB in %.2fs. Speed %.2fMB/s',
+                     downloaded_size / (1024.0 * 1024.0),
+                     end_time - start_time,
+                     speed)
+        return downloaded_size
+
+    def __download_response(self, response, filename, offset, total_size):
+        """
+        Write response body to a file starting at given offset
+        Return number of written bytes
+        """
+        mode = 'r+b' if offset else 'wb'
+        size = total_size - offset if total_size is not None else None
+        with open(filename, mode) as output_file:
+            output_file.seek(offset)
+            try:
+                written = self.__copy_response(response, output_file, size)
+            except Exception:
+                # Keep only bytes that were really written so download could be resumed
+                output_file.flush()
+                output_file.truncate(output_file.tell())
+                raise
+
+        return written
+
+    def __download_segments(self, path, response, filename, total_size):
+        """
+        Download file in several segments at the same time
+        First segment is read from already open response, others are fetched
+        with Range requests
+        Return number of written bytes
+        """
+        segment_size = int(math.ceil(float(total_size) / self.segments))
+        segments = [(start, min(start + segment_size, total_size) - 1)
+                    for start in range(0, total_size, segment_size)]
+        logging.info('Will download %s in %s segments of %.2fMB',
+                     path,
+                     len(segments),
+                     segment_size / (1024.0 * 1024.0))
         with open(filename, 'wb') as output_file:
-            total_chunk_size = 0
-            start_time = time.time()
-            while True:
-                chunk = response.read(chunk_size)
-                if chunk:
-                    output_file.write(chunk)
-                    output_file.flush()
-                    total_chunk_size += len(chunk)
-                else:
+            self.__preallocate(output_file, total_size)
+
+        errors = []
+
+        def download_segment(start, end, segment_response=None):
+            connection = None
+            try:
+                if segment_response is None:
+                    connection, segment_response = self.__request(
+                        path,
+                        {'Range': 'bytes=%s-%s' % (start, end)}
+                    )
+                    if segment_response.status != 206:
+                        raise Exception('Error %s downloading segment %s-%s of %s' % (
+                            segment_response.status, start, end, path))
+
+                with open(filename, 'r+b') as output_file:
+                    output_file.seek(start)
+                    self.__copy_response(segment_response, output_file, end - start + 1)
+
+                if connection:
+                    self.__release(connection, segment_response)
+                    connection = None
+            except Exception as ex:
+                logging.error('Segment %s-%s of %s failed: %s', start, end, path, ex)
+                errors.append(ex)
+            finally:
+                if connection:
+                    connection.close()
+
+        threads = []
+        for start, end in segments[1:]:
+            thread = threading.Thread(target=download_segment, args=(start, end))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        download_segment(segments[0][0], segments[0][1], response)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            os.remove(filename)
+            raise errors[0]
+
+        return total_size
+
+    @staticmethod
+    def __preallocate(output_file, size):
+        """
+        Reserve disk space for the whole file
+        """
+        output_file.flush()
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(output_file.fileno(), 0, size)
+                return
+            except OSError as ex:
+                logging.warning('Could not preallocate %s bytes: %s', size, ex)
+
+        output_file.truncate(size)
+
+    def __copy_response(self, response, output_file, size=None):
+        """
+        Copy up to size bytes (or everything if size is None) from response to file
+        Chunks are read into a reusable buffer when response supports it
+        Return number of copied bytes
+        """
+        buffer = bytearray(self.CHUNK_SIZE)
+        view = memoryview(buffer)
+        use_readinto = hasattr(response, 'readinto')
+        copied = 0
+        while size is None or copied < size:
+            to_read = self.CHUNK_SIZE
+            if size is not None:
+                to_read = min(to_read, size - copied)
+
+            if use_readinto:
+                read = response.readinto(view[:to_read])
+                if not read:
                     break
 
-            end_time = time.time()
-            speed = (total_chunk_size / (1024.0 * 1024.0)) / (end_time - start_time)
-            logging.info('Downloaded %.2fMB in %.2fs. Speed %.2fMB/s',
-                         total_chunk_size / (1024.0 * 1024.0),
-                         end_time - start_time,
-                         speed)
+                output_file.write(view[:read])
+            else:
+                chunk = response.read(to_read)
+                if not chunk:
+                    break
 
-        connection.close()
-        return filename
+                read = len(chunk)
+                output_file.write(chunk)
+
+            copied += read
+
+        if size is not None and copied < size:
+            raise Exception('Connection closed after %s of %s bytes' % (copied, size))
+
+        return copied
 
     def get_workflow(self, workflow_name):
         """
@@ -120,3 +501,53 @@ class CMSWebWrapper():
                           workflow_string,
                           ex)
             return None
+
+    def get_workflows(self, workflow_names, batch_size=50):
+        """
+        Get many workflows from ReqMgr2 with as few requests as possible
+        Workflows are requested in batches and each of them is cached as if it
+        was requested by get_workflow, workflows that are missing in batch
+        responses are fetched one by one
+        Return dictionary of workflow names and workflows (or None)
+        """
+        workflows = {}
+        missing_names = []
+        for workflow_name in sorted(set(workflow_names)):
+            path = '/reqmgr2/data/request?name=%s' % (workflow_name)
+            if self.cache.get(path) is not None:
+                workflows[workflow_name] = self.get_workflow(workflow_name)
+            else:
+                missing_names.append(workflow_name)
+
+        logging.info('%s of %s workflows are cached, will fetch %s in batches of %s',
+                     len(workflows),
+                     len(set(workflow_names)),
+                     len(missing_names),
+                     batch_size)
+        for start in range(0, len(missing_names), batch_size):
+            batch = missing_names[start:start + batch_size]
+            path = '/reqmgr2/data/request?%s' % ('&'.join('name=%s' % (n) for n in batch))
+            batch_string = self.get(path, cache=False)
+            batch_result = {}
+            if batch_string:
+                try:
+                    for result in json.loads(batch_string).get('result', []):
+                        batch_result.update(result)
+                except ValueError as ex:
+                    logging.error('Failed to parse batch of workflows JSON. %s', ex)
+
+            for workflow_name in batch:
+                workflow = batch_result.get(workflow_name)
+                if workflow:
+                    # Cache the same response that single workflow request would get
+                    single_path = '/reqmgr2/data/request?name=%s' % (workflow_name)
+                    self.cache.set(single_path,
+                                   json.dumps({'result': [{workflow_name: workflow}]}),
+                                   self.get_cache_ttl(single_path))
+                    workflows[workflow_name] = workflow
+                else:
+                    logging.info('Workflow %s is not in batch response, will get it alone',
+                                 workflow_name)
+                    workflows[workflow_name] = self.get_workflow(workflow_name)
+
+        return workflows
@@ -0,0 +1,121 @@
+"""
+Module that contains Downloader
+"""
+import logging
+import threading
+import time
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+class Downloader(object):
+    """
+    Downloader runs download tasks in a bounded pool of threads
+    It limits number of concurrent requests to each host and backs off
+    when hosts return errors
+    """
+
+    def __init__(self, threads=4, host_connections=4, max_backoff=60.0):
+        self.threads = max(1, threads)
+        self.host_connections = max(1, host_connections)
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.host_semaphores = {}
+        self.key_locks = {}
+        self.backoff = 0.0
+        self.total_bytes = 0
+        self.start_time = None
+        self.end_time = None
+
+    def host_slot(self, host):
+        """
+        Return semaphore that limits concurrent requests to given host
+        Use it as a context manager
+        """
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_connections)
+
+            return self.host_semaphores[host]
+
+    def key_lock(self, key):
+        """
+        Return lock for given key, e.g. file name, so same file would not
+        be downloaded by two threads at the same time
+        """
+        with self.lock:
+            if key not in self.key_locks:
+                self.key_locks[key] = threading.Lock()
+
+            return self.key_locks[key]
+
+    def wait_backoff(self):
+        """
+        Sleep for current back-off time
+        """
+        backoff = self.backoff
+        if backoff > 0:
+            logging.info('Backing off for %.1fs', backoff)
+            time.sleep(backoff)
+
+    def failed(self):
+        """
+        Report a failed request, back-off time is doubled
+        """
+        with self.lock:
+            self.backoff = min(self.max_backoff, max(1.0, self.backoff * 2))
+
+    def succeeded(self, transferred_bytes=0):
+        """
+        Report a successful request and number of bytes it transferred,
+        back-off time is halved
+        """
+        with self.lock:
+            self.total_bytes += transferred_bytes
+            self.backoff = self.backoff / 2 if self.backoff >= 1.0 else 0.0
+
+    def run(self, tasks):
+        """
+        Run all tasks (callables without arguments) and wait for them to finish
+        Exceptions of tasks are logged
+        """
+        task_queue = Queue()
+        for task in tasks:
+            task_queue.put(task)
+
+        def worker():
+            while True:
+                try:
+                    task = task_queue.get_nowait()
+                except Empty:
+                    return
+
+                try:
+                    task()
+                except Exception as ex:
+                    logging.error('Download task failed: %s', ex)
+
+        self.start_time = time.time()
+        workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        for thread in workers:
+            thread.join()
+
+        self.end_time = time.time()
+        self.log_speed()
+
+    def log_speed(self):
+        """
+        Log total downloaded bytes and average speed
+        """
+        duration = max(self.end_time - self.start_time, 0.001)
+        logging.info('Downloaded %.2fMB in %.2fs with %s threads. Speed %.2fMB/s',
+                     self.total_bytes / (1024.0 * 1024.0),
+                     duration,
+                     self.threads,
+                     self.total_bytes / (1024.0 * 1024.0) / duration)
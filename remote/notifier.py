@@ -0,0 +1,365 @@
+"""
+Module that contains Notifier
+"""
+import json
+import logging
+import threading
+import time
+import ssl
+from copy import deepcopy
+try:
+    from http.client import HTTPSConnection, HTTPConnection
+    from urllib.parse import urlparse, urljoin
+except ImportError:
+    from httplib import HTTPSConnection, HTTPConnection
+    from urlparse import urlparse, urljoin
+
+
+# Fields of category that are sent in progress updates
+CATEGORY_FIELDS = ('status', 'hlt_status', 'no_hlt_status')
+# Fields of relval that are sent in progress updates
+RELVAL_FIELDS = ('file_name', 'file_url', 'file_size', 'status', 'events', 'match')
+# HTTP codes of redirects that are followed, like curl -L did
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# How many redirects are followed before giving up
+MAX_REDIRECTS = 5
+# Longest pause between retries of the final update, in seconds
+MAX_CLOSE_BACKOFF = 60.0
+# HTTP codes of updates that service rejected, so retries would not help
+REJECTED_CODES = (400, 409)
+
+
+def get_relmon_changes(old_relmon, new_relmon):
+    """
+    Return list of category and relval fields that changed between two RelMon states
+    """
+    changes = []
+    old_categories = {c['name']: c for c in old_relmon.get('categories', [])}
+    for category in new_relmon.get('categories', []):
+        category_name = category['name']
+        old_category = old_categories.get(category_name, {})
+        fields = {}
+        for field in CATEGORY_FIELDS:
+            if field in category and category[field] != old_category.get(field):
+                fields[field] = category[field]
+
+        if fields:
+            changes.append({'category': category_name,
+                            'fields': fields})
+
+        for relval_type in ('reference', 'target'):
+            old_relvals = {r['name']: r for r in old_category.get(relval_type, [])}
+            for relval in category.get(relval_type, []):
+                old_relval = old_relvals.get(relval['name'], {})
+                fields = {}
+                for field in RELVAL_FIELDS:
+                    if field in relval and relval[field] != old_relval.get(field):
+                        fields[field] = relval[field]
+
+                if fields:
+                    changes.append({'category': category_name,
+                                    'type': relval_type,
+                                    'name': relval['name'],
+                                    'fields': fields})
+
+    return changes
+
+
+def read_cookie_file(cookie_file, host):
+    """
+    Read Netscape format cookie file made by cern-get-sso-cookie
+    Return value for Cookie header with cookies for given host
+    """
+    cookies = []
+    try:
+        with open(cookie_file) as cookies_file:
+            for line in cookies_file:
+                line = line.strip()
+                if line.startswith('#HttpOnly_'):
+                    line = line[len('#HttpOnly_'):]
+                elif not line or line.startswith('#'):
+                    continue
+
+                parts = line.split('\t')
+                if len(parts) < 7:
+                    continue
+
+                domain = parts[0].lstrip('.')
+                if host == domain or host.endswith('.' + domain):
+                    cookies.append('%s=%s' % (parts[5], parts[6]))
+    except IOError as ex:
+        logging.error('Could not read cookies from %s: %s', cookie_file, ex)
+
+    return '; '.join(cookies)
+
+
+class Notifier(object):
+    """
+    Notifier sends progress updates to RelMon service from a background thread
+    It keeps one connection to the service and coalesces bursts of updates, so
+    only the latest RelMon state is sent after a short window
+    Updates contain only fields that changed since the last acknowledged update
+    Requests are sent as POST to redirect locations too, like curl -X POST -L
+    """
+
+    def __init__(self, callback_url, cookie_file='cookie.txt', window=1.0, attempts=3):
+        self.callback_url = urlparse(callback_url)
+        self.cookie_file = cookie_file
+        self.window = window
+        self.attempts = attempts
+        self.connection = None
+        # Last state that RelMon service acknowledged
+        self.acknowledged = {}
+        # Latest state that is waiting to be sent
+        self.pending = None
+        # Latest state that could not be sent and HTTP code of the last attempt
+        self.unsent = None
+        self.unsent_status = None
+        self.sending = False
+        self.flushing = False
+        self.closed = False
+        self.sequence = int(time.time() * 1000)
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def acknowledge(self, relmon):
+        """
+        Set state that RelMon service already knows about
+        """
+        with self.condition:
+            self.acknowledged = deepcopy(relmon)
+
+    def notify(self, relmon):
+        """
+        Queue RelMon state to be sent
+        State replaces any other state that was not sent yet
+        """
+        with self.condition:
+            if self.closed:
+                logging.error('Notifier is closed, will not notify')
+                return
+
+            self.pending = (deepcopy(relmon), 0)
+            self.condition.notify_all()
+
+    def flush(self):
+        """
+        Wait until all queued states are sent
+        """
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+            while self.pending is not None or self.sending:
+                self.condition.wait(1)
+
+            self.flushing = False
+
+    def close(self, timeout=300):
+        """
+        Send queued state and stop the background thread
+        If state could not be sent, retry with back-off until timeout
+        Return whether the latest state was sent, so caller could fall back
+        to a full update
+        """
+        self.flush()
+        deadline = time.time() + timeout
+        backoff = 1.0
+        while True:
+            with self.condition:
+                unsent = self.unsent
+                rejected = self.unsent_status in REJECTED_CODES
+
+            if unsent is None or rejected or time.time() + backoff > deadline:
+                break
+
+            logging.info('Latest state was not sent, will retry in %.1fs', backoff)
+            time.sleep(backoff)
+            backoff = min(MAX_CLOSE_BACKOFF, backoff * 2)
+            with self.condition:
+                if self.pending is None:
+                    self.pending = (unsent, 0)
+                    self.condition.notify_all()
+
+            self.flush()
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.thread.join()
+        self.__close_connection()
+        if unsent is not None:
+            logging.error('Could not send latest state of %s', unsent['id'])
+
+        return unsent is None
+
+    def send_full_update(self, relmon):
+        """
+        Send whole RelMon without sequence, service replaces categories and
+        status regardless of earlier updates
+        Must be called only after notifier is closed
+        Return whether RelMon service accepted it
+        """
+        body = json.dumps({'id': relmon['id'],
+                           'status': relmon['status'],
+                           'categories': relmon.get('categories', [])},
+                          sort_keys=True)
+        logging.info('Sending full update of %s', relmon['id'])
+        status = self.__post(body)
+        if status != 200:
+            logging.error('Full update failed with HTTP code %s', status)
+
+        self.__close_connection()
+        return status == 200
+
+    def __run(self):
+        """
+        Background thread that sends pending states one after another
+        """
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+
+                if self.pending is None:
+                    return
+
+                # Let a burst of updates settle and send only the latest one
+                window_end = time.time() + self.window
+                while not self.flushing and not self.closed and time.time() < window_end:
+                    self.condition.wait(window_end - time.time())
+
+                relmon, attempt = self.pending
+                self.pending = None
+                self.sending = True
+                acknowledged = self.acknowledged
+
+            status = self.__send(relmon, acknowledged)
+            with self.condition:
+                self.sending = False
+                if status == 200:
+                    self.acknowledged = relmon
+                    self.unsent = None
+                else:
+                    self.unsent = relmon
+                    self.unsent_status = status
+                    if self.pending is None and attempt + 1 < self.attempts:
+                        # Retry unless a newer state is already waiting
+                        self.pending = (relmon, attempt + 1)
+
+                self.condition.notify_all()
+
+    @staticmethod
+    def __make_connection(url):
+        """
+        Return new connection to host of given URL
+        """
+        if url.scheme == 'https':
+            context = None
+            if hasattr(ssl, '_create_unverified_context'):
+                context = ssl._create_unverified_context()
+
+            return HTTPSConnection(url.hostname,
+                                   port=url.port or 443,
+                                   context=context,
+                                   timeout=60)
+
+        return HTTPConnection(url.hostname, port=url.port or 80, timeout=60)
+
+    def __close_connection(self):
+        """
+        Close persistent connection to RelMon service
+        """
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def __post_once(self, url, body):
+        """
+        POST body to given URL
+        Persistent connection is used for callback URL host and a new one
+        for other hosts, e.g. redirect locations
+        Return HTTP code and Location header of the response
+        """
+        path = url.path + ('?' + url.query if url.query else '')
+        headers = {'Content-Type': 'application/json',
+                   'Cookie': read_cookie_file(self.cookie_file, url.hostname)}
+        if (url.scheme, url.netloc) != (self.callback_url.scheme, self.callback_url.netloc):
+            connection = self.__make_connection(url)
+            try:
+                connection.request('POST', path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status, response.getheader('Location')
+            finally:
+                connection.close()
+
+        # Reconnect once if persistent connection went stale
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.connection = self.__make_connection(self.callback_url)
+
+                self.connection.request('POST', path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                response.read()
+                return response.status, response.getheader('Location')
+            except Exception:
+                self.__close_connection()
+                if attempt:
+                    raise
+
+        return None, None
+
+    def __post(self, body):
+        """
+        POST body to callback URL and follow redirects
+        Return HTTP code of the final response, None if request failed
+        """
+        url = self.callback_url
+        for _ in range(MAX_REDIRECTS + 1):
+            try:
+                status, location = self.__post_once(url, body)
+            except Exception as ex:
+                logging.warning('Notification failed: %s', ex)
+                return None
+
+            if status not in REDIRECT_CODES or not location:
+                return status
+
+            url = urlparse(urljoin(url.geturl(), location))
+            logging.info('Following redirect (%s) to %s', status, url.geturl())
+
+        logging.warning('Notification was redirected more than %s times', MAX_REDIRECTS)
+        return None
+
+    def __send(self, relmon, acknowledged):
+        """
+        Send changes between acknowledged and given RelMon state
+        Return HTTP code of the response, None if request failed
+        """
+        changes = get_relmon_changes(acknowledged, relmon)
+        status_changed = relmon['status'] != acknowledged.get('status')
+        if not changes and not status_changed:
+            logging.info('Nothing changed, will not notify')
+            return 200
+
+        self.sequence += 1
+        notify_data = {'id': relmon['id'],
+                       'sequence': self.sequence,
+                       'changes': changes}
+        if status_changed:
+            notify_data['status'] = relmon['status']
+
+        body = json.dumps(notify_data, sort_keys=True)
+        logging.info('Notifying about %s changes, sequence %s...', len(changes), self.sequence)
+        status = self.__post(body)
+        if status == 409:
+            # Service already has a newer update or RelMon was deleted
+            logging.warning('Update %s was rejected as outdated', self.sequence)
+        elif status not in (200, None):
+            logging.warning('Notification failed with HTTP code %s', status)
+
+        return status
@@ -0,0 +1,263 @@
+"""
+Module that pairs references with targets based on similarity of their names
+Names are split to character trigrams once and similarity matrix is computed
+as cosine similarity of trigram count vectors
+Pairs are chosen by solving assignment problem that maximizes total similarity
+NumPy and SciPy are used if they are available
+"""
+import logging
+import random
+import time
+from collections import Counter
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+def get_trigrams(string):
+    """
+    Return counter of character trigrams of a string
+    String is padded, so beginning and end have more weight
+    """
+    string = '  %s ' % (string)
+    return Counter(string[i:i + 3] for i in range(len(string) - 2))
+
+
+def get_similarity_matrix(reference_strings, target_strings):
+    """
+    Return matrix (list of lists or numpy array) of cosine similarities
+    between trigram vectors of each reference and each target string
+    """
+    reference_trigrams = [get_trigrams(s) for s in reference_strings]
+    target_trigrams = [get_trigrams(s) for s in target_strings]
+    if numpy is not None:
+        vocabulary = {}
+        for trigrams in reference_trigrams + target_trigrams:
+            for trigram in trigrams:
+                vocabulary.setdefault(trigram, len(vocabulary))
+
+        def make_vectors(all_trigrams):
+            vectors = numpy.zeros((len(all_trigrams), len(vocabulary)))
+            for row, trigrams in enumerate(all_trigrams):
+                columns = [vocabulary[trigram] for trigram in trigrams]
+                vectors[row, columns] = list(trigrams.values())
+
+            norms = numpy.linalg.norm(vectors, axis=1)
+            norms[norms == 0] = 1
+            return vectors / norms[:, numpy.newaxis]
+
+        return make_vectors(reference_trigrams).dot(make_vectors(target_trigrams).T)
+
+    def norm(trigrams):
+        return sum(count * count for count in trigrams.values()) ** 0.5 or 1
+
+    reference_norms = [norm(t) for t in reference_trigrams]
+    target_norms = [norm(t) for t in target_trigrams]
+    matrix = []
+    for reference, reference_norm in zip(reference_trigrams, reference_norms):
+        row = []
+        for target, target_norm in zip(target_trigrams, target_norms):
+            shorter, longer = sorted((reference, target), key=len)
+            dot_product = sum(count * longer.get(trigram, 0)
+                              for trigram, count in shorter.items())
+            row.append(dot_product / (reference_norm * target_norm))
+
+        matrix.append(row)
+
+    return matrix
+
+
+def solve_assignment(matrix):
+    """
+    Return list of (row, column) pairs that maximize sum of similarities
+    Each row and each column is used at most once
+    Uses SciPy if it is available, otherwise Hungarian algorithm
+    """
+    if linear_sum_assignment is not None and numpy is not None:
+        rows, columns = linear_sum_assignment(-numpy.asarray(matrix))
+        return list(zip(rows.tolist(), columns.tolist()))
+
+    rows = len(matrix)
+    columns = len(matrix[0]) if rows else 0
+    if not rows or not columns:
+        return []
+
+    # Hungarian algorithm works with costs and needs rows <= columns
+    transposed = rows > columns
+    if transposed:
+        costs = [[-matrix[row][column] for row in range(rows)] for column in range(columns)]
+        rows, columns = columns, rows
+    else:
+        costs = [[-value for value in row] for row in matrix]
+
+    if numpy is not None:
+        column_rows = hungarian_numpy(numpy.asarray(costs), rows, columns)
+    else:
+        column_rows = hungarian(costs, rows, columns)
+
+    pairs = []
+    for column in range(1, columns + 1):
+        row = column_rows[column]
+        if row:
+            pairs.append((column - 1, row - 1) if transposed else (row - 1, column - 1))
+
+    return sorted(pairs)
+
+
+def hungarian(costs, rows, columns):
+    """
+    Hungarian algorithm with potentials, O(rows^2 * columns)
+    Return list where index is column (1-based) and value is assigned row (1-based)
+    or 0 if column is not assigned
+    """
+    infinity = float('inf')
+    row_potential = [0.0] * (rows + 1)
+    column_potential = [0.0] * (columns + 1)
+    column_rows = [0] * (columns + 1)
+    way = [0] * (columns + 1)
+    for row in range(1, rows + 1):
+        column_rows[0] = row
+        current_column = 0
+        min_values = [infinity] * (columns + 1)
+        used = [False] * (columns + 1)
+        while True:
+            used[current_column] = True
+            current_row = column_rows[current_column]
+            row_costs = costs[current_row - 1]
+            current_potential = row_potential[current_row]
+            delta = infinity
+            next_column = 0
+            for column in range(1, columns + 1):
+                if used[column]:
+                    continue
+
+                value = row_costs[column - 1] - current_potential - column_potential[column]
+                if value < min_values[column]:
+                    min_values[column] = value
+                    way[column] = current_column
+
+                if min_values[column] < delta:
+                    delta = min_values[column]
+                    next_column = column
+
+            for column in range(columns + 1):
+                if used[column]:
+                    row_potential[column_rows[column]] += delta
+                    column_potential[column] -= delta
+                else:
+                    min_values[column] -= delta
+
+            current_column = next_column
+            if not column_rows[current_column]:
+                break
+
+        while current_column:
+            previous_column = way[current_column]
+            column_rows[current_column] = column_rows[previous_column]
+            current_column = previous_column
+
+    return column_rows
+
+
+def hungarian_numpy(costs, rows, columns):
+    """
+    Same as hungarian, but inner loops over columns are vectorized with NumPy
+    """
+    row_potential = numpy.zeros(rows + 1)
+    column_potential = numpy.zeros(columns + 1)
+    column_rows = numpy.zeros(columns + 1, dtype=int)
+    way = numpy.zeros(columns + 1, dtype=int)
+    # Pad costs with a zero column, so column indices match other arrays
+    costs = numpy.hstack((numpy.zeros((rows, 1)), costs))
+    for row in range(1, rows + 1):
+        column_rows[0] = row
+        current_column = 0
+        min_values = numpy.full(columns + 1, numpy.inf)
+        used = numpy.zeros(columns + 1, dtype=bool)
+        while True:
+            used[current_column] = True
+            current_row = column_rows[current_column]
+            values = costs[current_row - 1] - row_potential[current_row] - column_potential
+            improved = ~used & (values < min_values)
+            min_values[improved] = values[improved]
+            way[improved] = current_column
+            free_values = numpy.where(used, numpy.inf, min_values)
+            next_column = int(numpy.argmin(free_values))
+            delta = free_values[next_column]
+            row_potential[column_rows[used]] += delta
+            column_potential[used] -= delta
+            min_values[~used] -= delta
+            current_column = next_column
+            if not column_rows[current_column]:
+                break
+
+        while current_column:
+            previous_column = way[current_column]
+            column_rows[current_column] = column_rows[previous_column]
+            current_column = previous_column
+
+    return column_rows.tolist()
+
+
+def pair_strings(reference_strings, target_strings):
+    """
+    Return list of (reference index, target index, similarity) tuples of
+    optimal pairs of given strings
+    """
+    if not reference_strings or not target_strings:
+        return []
+
+    matrix = get_similarity_matrix(reference_strings, target_strings)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for reference_index, reference_string in enumerate(reference_strings):
+            for target_index, target_string in enumerate(target_strings):
+                logging.debug('%s %s -> %.3f',
+                              reference_string,
+                              target_string,
+                              matrix[reference_index][target_index])
+
+    return [(row, column, float(matrix[row][column]))
+            for row, column in solve_assignment(matrix)]
+
+
+def benchmark(size, seed=0):
+    """
+    Pair two synthetic buckets of given size and print how long it took
+    """
+    random.seed(seed)
+
+    def make_string():
+        return 'RelValSample%s_%s_%s' % (random.randint(0, size),
+                                         random.choice(('PU', 'noPU', 'HLT', '')),
+                                         random.randint(0, 1000000))
+
+    reference_strings = [make_string() for _ in range(size)]
+    target_strings = [make_string() for _ in range(size)]
+    start = time.time()
+    matrix = get_similarity_matrix(reference_strings, target_strings)
+    matrix_time = time.time() - start
+    start = time.time()
+    pairs = solve_assignment(matrix)
+    assignment_time = time.time() - start
+    print('%sx%s: similarity matrix %.3fs, assignment %.3fs, %s pairs. NumPy: %s, SciPy: %s'
+          % (size,
+             size,
+             matrix_time,
+             assignment_time,
+             len(pairs),
+             numpy is not None,
+             linear_sum_assignment is not None))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark pairing of synthetic buckets')
+    parser.add_argument('--size', type=int, default=1000, help='Number of references and targets')
+    args = vars(parser.parse_args())
+    benchmark(args['size'])
@@ -13,12 +13,30 @@ import re
 import logging
 import subprocess
 import os
-import time
 import sys
 import traceback
-from difflib import SequenceMatcher
+import threading
+import time
+from functools import partial
 from cmswebwrapper import CMSWebWrapper
+from downloader import Downloader
+from notifier import Notifier
 from events import get_events
+from pairing import pair_strings
+from report_postprocessor import postprocess_report
+
+
+# How many times to try to download a file
+DOWNLOAD_ATTEMPTS = 3
+# Lock for reading events from root files
+EVENTS_LOCK = threading.Lock()
+# Links to files in DQM directory listings
+HYPERLINK_REGEX = re.compile("href=['\"]([-\\._a-zA-Z/\\d]*)['\"]")
+# Parsed DQM directory listings, locks for fetching each of them and
+# lock for accessing both dictionaries
+DQM_LISTING_INDEXES = {}
+DQM_LISTING_LOCKS = {}
+DQM_LISTING_LOCK = threading.Lock()
 
 
 def get_dqmio_dataset(workflow):
@@ -34,6 +52,60 @@ def get_dqmio_dataset(workflow):
     return None
 
 
+def get_dqm_listing_index(cmsweb, cmsweb_dqm_dir_link):
+    """
+    Return index of root files in DQM directory listing
+    Index keys are dataset__CMSSW-processingstring- prefixes of file names and
+    values are sorted lists of links with that prefix, i.e. different versions
+    Each listing is fetched and parsed only once, different listings are
+    fetched concurrently
+    """
+    with DQM_LISTING_LOCK:
+        if cmsweb_dqm_dir_link in DQM_LISTING_INDEXES:
+            return DQM_LISTING_INDEXES[cmsweb_dqm_dir_link]
+
+        listing_lock = DQM_LISTING_LOCKS.setdefault(cmsweb_dqm_dir_link, threading.Lock())
+
+    with listing_lock:
+        with DQM_LISTING_LOCK:
+            # Other thread might have fetched it while waiting for the lock
+            if cmsweb_dqm_dir_link in DQM_LISTING_INDEXES:
+                return DQM_LISTING_INDEXES[cmsweb_dqm_dir_link]
+
+        response = cmsweb.get(cmsweb_dqm_dir_link)
+        if not response:
+            return {}
+
+        hyperlinks = HYPERLINK_REGEX.findall(response)[1:]
+        index = {}
+        for hyperlink in hyperlinks:
+            # DQM_V0001_R000000001__<dataset>__<CMSSW>-<processing string>-<version>__DQMIO.root
+            file_name_parts = hyperlink.split('/')[-1].split('__')
+            if len(file_name_parts) < 3:
+                continue
+
+            processed_dataset_parts = file_name_parts[2].split('-')
+            if len(processed_dataset_parts) < 3:
+                continue
+
+            key = '%s__%s-%s-' % (file_name_parts[1],
+                                  processed_dataset_parts[0],
+                                  processed_dataset_parts[1])
+            index.setdefault(key, []).append(hyperlink)
+
+        for links in index.values():
+            links.sort()
+
+        logging.info('Indexed %s links of %s under %s keys',
+                     len(hyperlinks),
+                     cmsweb_dqm_dir_link,
+                     len(index))
+        with DQM_LISTING_LOCK:
+            DQM_LISTING_INDEXES[cmsweb_dqm_dir_link] = index
+
+        return index
+
+
 def get_root_file_path_for_dataset(cmsweb, dqmio_dataset, category_name):
     """
     Get list of URLs for given dataset
@@ -52,57 +124,31 @@ def get_root_file_path_for_dataset(cmsweb, dqmio_dataset, category_name):
         cmsweb_dqm_dir_link = '/dqm/relval/data/browse/ROOT/RelVal/'
 
     cmsweb_dqm_dir_link += '_'.join(cmssw.split('_')[:3]) + '_x/'
-    response = cmsweb.get(cmsweb_dqm_dir_link)
-    hyperlink_regex = re.compile("href=['\"]([-\\._a-zA-Z/\\d]*)['\"]")
-    hyperlinks = hyperlink_regex.findall(response)[1:]
-    hyperlinks = list(hyperlinks)
-    logging.info('Substring to look for: %s. Total links in page: %s. Looking in %s',
+    index = get_dqm_listing_index(cmsweb, cmsweb_dqm_dir_link)
+    hyperlinks = list(index.get(dataset_part, []))
+    logging.info('Selected hyperlinks for %s in %s: %s',
                  dataset_part,
-                 len(hyperlinks),
-                 cmsweb_dqm_dir_link)
-    hyperlinks = [x for x in hyperlinks if dataset_part in x]
-    hyperlinks = sorted(hyperlinks)
-    logging.info('Selected hyperlinks %s', json.dumps(hyperlinks, indent=2, sort_keys=True))
+                 cmsweb_dqm_dir_link,
+                 json.dumps(hyperlinks, indent=2, sort_keys=True))
     return hyperlinks
 
 
-def notify(relmon, callback_url):
+def download_root_files(relmon, cmsweb, notifier, downloader):
     """
-    Send a notification about progress back to RelMon service
+    Download all files needed for comparison and fill relmon dictionary
+    Files are downloaded concurrently by the downloader
     """
+    relmon_lock = threading.Lock()
 
-    with open('notify_data.json', 'w') as json_file:
-        json.dump(relmon, json_file, indent=2, sort_keys=True)
-
-    command = ['curl',
-               '-X',
-               'POST',
-               '--cookie cookie.txt',
-               callback_url,
-               '-s',
-               '-k',
-               '-L',
-               '-m',
-               '60',
-               '-d',
-               '@notify_data.json',
-               '-H',
-               '\'Content-Type: application/json\'',
-               '-o',
-               '/dev/null']
-    command = ' '.join(command)
-    logging.info('Notifying...')
-    proc = subprocess.Popen(command,
-                            shell=True)
-    proc.wait()
-    os.remove('notify_data.json')
-    time.sleep(0.05)
-
+    def update_item(item, fields):
+        """
+        Update item and notify about it while no other thread changes relmon
+        """
+        with relmon_lock:
+            item.update(fields)
+            notifier.notify(relmon)
 
-def download_root_files(relmon, cmsweb, callback_url):
-    """
-    Download all files needed for comparison and fill relmon dictionary
-    """
+    items = []
     for category in relmon.get('categories', []):
         if category['status'] != 'initial':
             continue
@@ -111,56 +157,111 @@ def download_root_files(relmon, cmsweb, callback_url):
         reference_list = category.get('reference', [])
         target_list = category.get('target', [])
         for item in reference_list + target_list:
-            workflow = cmsweb.get_workflow(item['name'])
-            if not workflow:
-                item['status'] = 'no_workflow'
-                notify(relmon, callback_url)
-                logging.warning('Could not find workflow %s in ReqMgr2', item['name'])
-                continue
-
-            dqmio_dataset = get_dqmio_dataset(workflow)
-            if not dqmio_dataset:
-                item['status'] = 'no_dqmio'
-                notify(relmon, callback_url)
-                logging.warning('Could not find DQMIO dataset in %s. Datasets: %s',
-                                item['name'],
-                                ', '.join(workflow.get('OutputDatasets', [])))
-                continue
-
-            file_urls = get_root_file_path_for_dataset(cmsweb, dqmio_dataset, category_name)
-            if not file_urls:
-                item['status'] = 'no_root'
-                notify(relmon, callback_url)
-                logging.warning('Could not get root file path for %s dataset of %s workflow',
-                                dqmio_dataset,
-                                item['name'])
-                continue
-
-            item['versioned'] = len(file_urls) > 1
-            file_url = file_urls[-1]
+            items.append((category_name, item))
+
+    # Resolve all workflows at once instead of one request per item
+    with downloader.host_slot(cmsweb.host):
+        workflows = cmsweb.get_workflows([item['name'] for _, item in items])
+
+    def download_task(item, workflow, category_name):
+        """
+        Download item and mark it as failed if anything goes wrong, so no
+        item is left in a non-final status
+        """
+        try:
+            download_item(item, workflow, category_name, cmsweb, downloader, update_item)
+        except Exception as ex:
+            logging.error('Error downloading %s: %s', item['name'], ex)
+            logging.error(traceback.format_exc())
+            update_item(item, {'status': 'failed'})
+
+    tasks = []
+    for category_name, item in items:
+        tasks.append(partial(download_task,
+                             item,
+                             workflows.get(item['name']),
+                             category_name))
+
+    logging.info('Will download files of %s items', len(tasks))
+    downloader.run(tasks)
+
+
+def download_item(item, workflow, category_name, cmsweb, downloader, update_item):
+    """
+    Find and download root file of a single reference or target
+    """
+    if not workflow:
+        update_item(item, {'status': 'no_workflow'})
+        logging.warning('Could not find workflow %s in ReqMgr2', item['name'])
+        return
+
+    dqmio_dataset = get_dqmio_dataset(workflow)
+    if not dqmio_dataset:
+        update_item(item, {'status': 'no_dqmio'})
+        logging.warning('Could not find DQMIO dataset in %s. Datasets: %s',
+                        item['name'],
+                        ', '.join(workflow.get('OutputDatasets', [])))
+        return
+
+    with downloader.host_slot(cmsweb.host):
+        file_urls = get_root_file_path_for_dataset(cmsweb, dqmio_dataset, category_name)
+
+    if not file_urls:
+        update_item(item, {'status': 'no_root'})
+        logging.warning('Could not get root file path for %s dataset of %s workflow',
+                        dqmio_dataset,
+                        item['name'])
+        return
+
+    file_url = file_urls[-1]
+    logging.info('File URL for %s is %s', item['name'], file_url)
+    update_item(item, {'versioned': len(file_urls) > 1,
+                       'file_url': file_url,
+                       'file_size': 0,
+                       'status': 'downloading',
+                       'file_name': file_url.split('/')[-1],
+                       'events': 0})
+    file_name = None
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        downloader.wait_backoff()
+        try:
+            # Same file might be needed by more than one item
+            # Transferred bytes and failures are reported to downloader by cmsweb
+            with downloader.key_lock(file_url), downloader.host_slot(cmsweb.host):
+                file_name = cmsweb.get_big_file(file_url)
+
+            break
+        except Exception as ex:
+            logging.error(ex)
+            logging.error('Error getting %s for %s, attempt %s/%s',
+                          file_url,
+                          item['name'],
+                          attempt,
+                          DOWNLOAD_ATTEMPTS)
+            file_name = None
+
+    if not file_name:
+        update_item(item, {'status': 'failed'})
+        return
 
-            logging.info('File URL for %s is %s', item['name'], file_url)
-            item['file_url'] = file_url
-            item['file_size'] = 0
-            item['status'] = 'downloading'
-            item['file_name'] = item['file_url'].split('/')[-1]
-            item['events'] = 0
-            notify(relmon, callback_url)
-            try:
-                item['file_name'] = cmsweb.get_big_file(item['file_url'])
-                item['status'] = 'downloaded'
-                item['file_size'] = os.path.getsize(item['file_name'])
-                item['events'] = get_events(item['file_name'])
-                logging.info('Downloaded %s. Size %.2f MB. Events %s',
-                             item['file_name'],
-                             item.get('file_size', 0) / 1024.0 / 1024.0,
-                             item['events'])
-            except Exception as ex:
-                logging.error(ex)
-                logging.error('Error getting %s for %s', item['file_url'], item['name'])
-                item['status'] = 'failed'
+    try:
+        file_size = os.path.getsize(file_name)
+        # ROOT is not thread safe
+        with EVENTS_LOCK:
+            events = get_events(file_name)
+    except Exception as ex:
+        logging.error('Error reading %s for %s: %s', file_name, item['name'], ex)
+        update_item(item, {'status': 'failed'})
+        return
 
-            notify(relmon, callback_url)
+    logging.info('Downloaded %s. Size %.2f MB. Events %s',
+                 file_name,
+                 file_size / 1024.0 / 1024.0,
+                 events)
+    update_item(item, {'file_name': file_name,
+                       'status': 'downloaded',
+                       'file_size': file_size,
+                       'events': events})
 
 
 def get_local_subreport_path(category_name, hlt):
@@ -240,79 +341,71 @@ def pair_references_with_targets(category):
     reference_tree = make_file_tree(references, category['name'])
     target_tree = make_file_tree(targets, category['name'])
 
-    logging.info('References tree: %s', json.dumps(reference_tree, indent=2, sort_keys=True))
-    logging.info('Targets tree: %s', json.dumps(target_tree, indent=2, sort_keys=True))
+    logging.info('References tree has %s datasets, targets tree has %s datasets',
+                 len(reference_tree),
+                 len(target_tree))
 
     selected_pairs = []
 
     for reference_dataset, reference_runs in reference_tree.items():
         for reference_run, references_in_run in reference_runs.items():
             targets_in_run = target_tree.get(reference_dataset, {}).get(reference_run, [])
-            if len(references_in_run) == 1 and len(targets_in_run) == 1:
-                reference = references_in_run.pop()
-                target = targets_in_run.pop()
+            if not targets_in_run:
+                continue
+
+            if len(references_in_run) > 1 or len(targets_in_run) > 1:
+                logging.info('Dataset %s. Run %s. Will try to match %s references with %s targets',
+                             reference_dataset,
+                             reference_run,
+                             len(references_in_run),
+                             len(targets_in_run))
+
+            reference_strings = [get_important_part(r['file_name']) for r in references_in_run]
+            target_strings = [get_important_part(t['file_name']) for t in targets_in_run]
+            pairs = pair_strings(reference_strings, target_strings)
+            for reference_index, target_index, similarity_ratio in pairs:
+                reference = references_in_run[reference_index]
+                target = targets_in_run[target_index]
                 reference_name = reference['file_name']
                 target_name = target['file_name']
-                logging.info('Pair %s with %s', reference_name, target_name)
+                logging.info('Pair %s with %s. Similarity %.3f',
+                             reference_name,
+                             target_name,
+                             similarity_ratio)
+                selected_pairs.append((reference_name, target_name))
                 reference['match'] = target['name']
                 target['match'] = reference['name']
-                selected_pairs.append((reference_name, target_name))
-            else:
-                logging.info('Dataset %s. Run %s. Will try to match %s\nwith\n%s',
-                             reference_dataset,
-                             reference_run,
-                             json.dumps(references_in_run, indent=2, sort_keys=True),
-                             json.dumps(targets_in_run, indent=2, sort_keys=True))
-
-                all_ratios = []
-                for reference in references_in_run:
-                    for target in targets_in_run:
-                        reference_string = get_important_part(reference['file_name'])
-                        target_string = get_important_part(target['file_name'])
-                        ratio = SequenceMatcher(a=reference_string, b=target_string).ratio()
-                        reference_target_ratio = (reference, target, ratio)
-                        all_ratios.append(reference_target_ratio)
-                        logging.info('%s %s -> %s', reference_string, target_string, ratio)
-
-                used_references = set()
-                used_targets = set()
-                all_ratios.sort(key=lambda x: x[2], reverse=True)
-                for reference_target_ratio in all_ratios:
-                    reference_name = reference_target_ratio[0]['file_name']
-                    target_name = reference_target_ratio[1]['file_name']
-                    similarity_ratio = reference_target_ratio[2]
-                    if reference_name not in used_references and target_name not in used_targets:
-                        logging.info('Pair %s with %s. Similarity %.3f',
-                                     reference_name,
-                                     target_name,
-                                     similarity_ratio)
-                        used_references.add(reference_name)
-                        used_targets.add(target_name)
-                        references_in_run.remove(reference_target_ratio[0])
-                        targets_in_run.remove(reference_target_ratio[1])
-                        selected_pairs.append((reference_name, target_name))
-                        reference_target_ratio[0]['match'] = reference_target_ratio[1]['name']
-                        reference_target_ratio[1]['match'] = reference_target_ratio[0]['name']
+
+            # Leave only items without pairs in the trees
+            paired_references = set(p[0] for p in pairs)
+            paired_targets = set(p[1] for p in pairs)
+            references_in_run[:] = [r for i, r in enumerate(references_in_run)
+                                    if i not in paired_references]
+            targets_in_run[:] = [t for i, t in enumerate(targets_in_run)
+                                 if i not in paired_targets]
 
     # Delete empty items wo there would be less to print
     clean_file_tree(reference_tree)
     clean_file_tree(target_tree)
+    leftovers = []
     for _, reference_runs in reference_tree.items():
         for _, references_in_run in reference_runs.items():
             for reference in references_in_run:
+                leftovers.append(reference['file_name'])
                 if reference['status'] == 'downloaded':
                     reference['status'] = 'no_match'
 
     for _, target_runs in target_tree.items():
         for _, targets_in_run in target_runs.items():
             for target in targets_in_run:
+                leftovers.append(target['file_name'])
                 if target['status'] == 'downloaded':
                     target['status'] = 'no_match'
 
-    logging.info('References leftovers tree: %s',
-                 json.dumps(reference_tree, indent=2, sort_keys=True))
-    logging.info('Targets leftovers tree: %s',
-                 json.dumps(target_tree, indent=2, sort_keys=True))
+    logging.info('%s pairs, %s leftovers: %s',
+                 len(selected_pairs),
+                 len(leftovers),
+                 ', '.join(leftovers))
 
     sorted_references = [x[0] for x in selected_pairs]
     sorted_targets = [x[1] for x in selected_pairs]
@@ -358,6 +451,8 @@ def get_dataset_lists(category):
 def compare_compress_move(category_name, hlt, reference_list, target_list, cpus, log_file):
     """
     The main function that compares, compresses and moves reports to Reports directory
+    Compression and moving is done by post-processor in the same pass
+    Return whether ValidationMatrix succeeded
     """
     subreport_path = get_local_subreport_path(category_name, hlt)
     comparison_command = ' '.join(['ValidationMatrix.py',
@@ -371,46 +466,44 @@ def compare_compress_move(category_name, hlt, reference_list, target_list, cpus,
                                    '--hash_name',
                                    '--HLT' if hlt else ''])
 
-    # Remove all /cms-service-reldqm/style/blueprint/ from HTML files
-    path_fix_command = ("find %s/ -type f -name '*.html' |xargs -L1 "
-                        "sed -i -e 's#/cms-service-reldqm/style/blueprint/##g'" % (subreport_path))
-    compression_command = ' '.join(['dir2webdir.py', subreport_path])
-    move_command = ' '.join(['mv', subreport_path, 'Reports/'])
-
     logging.info('ValidationMatrix command: %s', comparison_command)
     proc = subprocess.Popen(comparison_command,
                             stdout=log_file,
                             stderr=log_file,
                             shell=True)
     proc.communicate()
+    comparison_succeeded = proc.returncode == 0
+    if not comparison_succeeded:
+        logging.error('ValidationMatrix for %s exited with code %s',
+                      subreport_path,
+                      proc.returncode)
 
-    logging.info('Path fix command: %s', path_fix_command)
-    proc = subprocess.Popen(path_fix_command,
-                            stdout=log_file,
-                            stderr=log_file,
-                            shell=True)
-    proc.communicate()
+    # Fix blueprint paths, compress and move to Reports directory in one pass
+    postprocess_report(subreport_path, 'Reports/' + subreport_path, cpus)
+    return comparison_succeeded
 
-    logging.info('Compression command: %s', compression_command)
-    proc = subprocess.Popen(compression_command,
-                            stdout=log_file,
-                            stderr=log_file,
-                            shell=True)
-    proc.communicate()
 
-    logging.info('Move command: %s', move_command)
-    proc = subprocess.Popen(move_command,
-                            stdout=log_file,
-                            stderr=log_file,
-                            shell=True)
-    proc.communicate()
+def get_cpu_shares(cpus, slots):
+    """
+    Split CPUs between given number of slots as evenly as possible
+    Each slot gets at least one CPU
+    """
+    cpus = max(cpus, slots)
+    return [cpus // slots + (1 if slot < cpus % slots else 0) for slot in range(slots)]
 
 
-def run_validation_matrix(relmon, cpus, callback_url):
+def run_validation_matrix(relmon, cpus, notifier, max_units=2):
     """
-    Iterate through categories and start comparison process
+    Iterate through categories and compare, compress and move their reports
+    Each category with HLT and without HLT is a separate unit, at most
+    max_units units run concurrently (0 - one per CPU) and CPUs are split
+    between them
+    Each unit needs it's own memory, so job's memory request must match max_units
+    Status of unit is stored in hlt_status or no_hlt_status of category
     """
-    log_file = open("validation_matrix.log", "w")
+    relmon_lock = threading.Lock()
+    units = []
+    category_units = {}
     for category in relmon.get('categories', []):
         if category['status'] != 'initial':
             continue
@@ -428,35 +521,102 @@ def run_validation_matrix(relmon, cpus, callback_url):
         logging.info('Category: %s', category_name)
         logging.info('HLT: %s', hlt)
         reference_list, target_list = get_dataset_lists(category)
+        unit_hlts = []
         if reference_list and target_list:
-            category['status'] = 'comparing'
-            notify(relmon, callback_url)
             # Run Generator without HLT
             # Do not run Generator with HLT
             if hlt in ('only', 'both') and category_name.lower() != 'generator':
-                # Run with HLT
-                # Do not run generator with HLT
-                compare_compress_move(category_name,
-                                      True,
-                                      reference_list,
-                                      target_list,
-                                      cpus,
-                                      log_file)
+                unit_hlts.append(True)
 
             if hlt in ('no', 'both') or category_name.lower() == 'generator':
-                # Run without HLT
-                # Run Generator without HLT
-                compare_compress_move(category_name,
-                                      False,
-                                      reference_list,
-                                      target_list,
-                                      cpus,
-                                      log_file)
+                unit_hlts.append(False)
+
+        for unit_hlt in unit_hlts:
+            units.append((category, unit_hlt, reference_list, target_list))
+            category['hlt_status' if unit_hlt else 'no_hlt_status'] = 'waiting'
+
+        category_units[category_name] = len(unit_hlts)
+        if not unit_hlts:
+            category['status'] = 'done'
+
+    notifier.notify(relmon)
+    if not units:
+        return
+
+    # Start biggest units first, so they would not be left running alone at the end
+    units.sort(key=lambda unit: len(unit[2]), reverse=True)
+    slots = min(len(units), max(1, cpus))
+    if max_units > 0:
+        slots = min(slots, max_units)
+
+    cpu_shares = get_cpu_shares(cpus, slots)
+    logging.info('Will run %s units in %s slots with %s CPUs', len(units), slots, cpu_shares)
+
+    def run_units(slot_cpus):
+        """
+        Take units one by one and run them with given number of CPUs
+        """
+        while True:
+            with relmon_lock:
+                if not units:
+                    return
+
+                category, hlt, reference_list, target_list = units.pop(0)
+                status_key = 'hlt_status' if hlt else 'no_hlt_status'
+                category['status'] = 'comparing'
+                category[status_key] = 'comparing'
+                notifier.notify(relmon)
+
+            category_name = category['name']
+            subreport_path = get_local_subreport_path(category_name, hlt)
+            log_file_name = 'validation_matrix_%s.log' % (subreport_path)
+            start_time = time.time()
+            try:
+                with open(log_file_name, 'w') as log_file:
+                    succeeded = compare_compress_move(category_name,
+                                                      hlt,
+                                                      reference_list,
+                                                      target_list,
+                                                      slot_cpus,
+                                                      log_file)
+            except Exception as ex:
+                logging.error('Comparison of %s failed: %s', category_name, ex)
+                succeeded = False
+
+            logging.info('%s finished in %.2fs with %s CPUs',
+                         subreport_path,
+                         time.time() - start_time,
+                         slot_cpus)
+            with relmon_lock:
+                category[status_key] = 'done' if succeeded else 'failed'
+                category_units[category_name] -= 1
+                if not category_units[category_name]:
+                    category['status'] = 'done'
+
+                notifier.notify(relmon)
+
+    threads = [threading.Thread(target=run_units, args=(slot_cpus, ))
+               for slot_cpus in cpu_shares]
+    for thread in threads:
+        thread.start()
 
-        category['status'] = 'done'
-        notify(relmon, callback_url)
+    for thread in threads:
+        thread.join()
 
-    log_file.close()
+    # Merge logs of all units into one file
+    with open('validation_matrix.log', 'w') as log_file:
+        for category in relmon.get('categories', []):
+            for hlt in (True, False):
+                subreport_path = get_local_subreport_path(category['name'], hlt)
+                unit_log_name = 'validation_matrix_%s.log' % (subreport_path)
+                if not os.path.isfile(unit_log_name):
+                    continue
+
+                log_file.write('===== %s =====\n' % (subreport_path))
+                with open(unit_log_name) as unit_log_file:
+                    log_file.write(unit_log_file.read())
+
+                os.remove(unit_log_name)
 
 
 def main():
@@ -486,6 +646,26 @@ def main():
                         type=int,
                         default=1,
                         help='Number of CPU cores for ValidationMatrix')
+    parser.add_argument('--units',
+                        type=int,
+                        default=2,
+                        help='Maximum number of concurrent ValidationMatrix runs, 0 - one per CPU')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=4,
+                        help='Number of concurrent file downloads')
+    parser.add_argument('--host-connections',
+                        type=int,
+                        default=4,
+                        help='Maximum number of concurrent requests to a single host')
+    parser.add_argument('--segments',
+                        type=int,
+                        default=1,
+                        help='Number of parallel segments for files bigger than 1GB')
+    parser.add_argument('--cache',
+                        type=str,
+                        default='cmsweb_cache.sqlite',
+                        help='SQLite file for persistent cache of cmsweb responses')
     parser.add_argument('--callback',
                         type=str,
                         help='URL for callbacks')
@@ -517,6 +697,9 @@ def main():
     with open(relmon_filename) as relmon_file:
         relmon = json.load(relmon_file)
 
+    notifier = Notifier(callback_url)
+    notifier.acknowledge(relmon)
+
     try:
         if notify_done:
             if relmon['status'] != 'failed':
@@ -528,11 +711,21 @@ def main():
                 cert_file = proxy_file
                 key_file = proxy_file
 
-            cmsweb = CMSWebWrapper(cert_file, key_file)
+            downloader = Downloader(threads=args.get('threads', 4),
+                                    host_connections=args.get('host_connections', 4))
+            # ReqMgr2, DQM listing and file requests all affect back-off
+            cmsweb = CMSWebWrapper(cert_file,
+                                   key_file,
+                                   segments=args.get('segments', 1),
+                                   connections=args.get('host_connections', 4),
+                                   cache_file=args.get('cache'),
+                                   on_success=downloader.succeeded,
+                                   on_failure=downloader.failed)
             relmon['status'] = 'running'
-            notify(relmon, callback_url)
-            download_root_files(relmon, cmsweb, callback_url)
-            run_validation_matrix(relmon, cpus, callback_url)
+            notifier.notify(relmon)
+            download_root_files(relmon, cmsweb, notifier, downloader)
+            cmsweb.close()
+            run_validation_matrix(relmon, cpus, notifier, args.get('units', 2))
             relmon['status'] = 'finishing'
     except Exception as ex:
         logging.error(ex)
@@ -542,7 +735,10 @@ def main():
         with open(relmon_filename, 'w') as relmon_file:
             json.dump(relmon, relmon_file, indent=2, sort_keys=True)
 
-    notify(relmon, callback_url)
+    notifier.notify(relmon)
+    if not notifier.close():
+        # Partial updates keep failing, service gets the whole RelMon instead
+        notifier.send_full_update(relmon)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+"""
+Catalog of published reports
+Catalog is a small SQLite file next to report files, so report listing and
+search do not have to open or stat every report file
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+
+# Name of catalog file in directory of reports
+CATALOG_FILE = 'reports_catalog.db'
+# Tables of report files that are not categories
+SERVICE_TABLES = ('manifest', 'blobs', 'metadata')
+
+
+def open_catalog(catalog_path):
+    """
+    Open catalog and create it's table if it does not exist
+    Catalog might be updated by several jobs at once, so wait for locks
+    """
+    connection = sqlite3.connect(catalog_path, timeout=120)
+    connection.execute('CREATE TABLE IF NOT EXISTS reports (id text PRIMARY KEY, '
+                       'name text, '
+                       'file_name text, '
+                       'size integer, '
+                       'mtime real, '
+                       'categories text);')
+    connection.execute('CREATE INDEX IF NOT EXISTS reports_mtime ON reports(mtime);')
+    connection.commit()
+    return connection
+
+
+def get_report_categories(report_path):
+    """
+    Return sorted list of categories in a report file
+    """
+    connection = sqlite3.connect('file:%s?mode=ro' % (report_path), uri=True)
+    try:
+        if connection.execute('PRAGMA user_version;').fetchone()[0] >= 2:
+            query = 'SELECT category FROM metadata ORDER BY category'
+        else:
+            query = ("SELECT name FROM sqlite_master WHERE type = 'table' "
+                     "AND name NOT IN ('%s') ORDER BY name" % ("', '".join(SERVICE_TABLES)))
+
+        return [row[0] for row in connection.execute(query)]
+    finally:
+        connection.close()
+
+
+def get_report_entry(report_path):
+    """
+    Return catalog entry of a report file
+    Report ID and name are taken from <id>___<name>.sqlite file name
+    """
+    file_name = os.path.basename(report_path)[:-len('.sqlite')]
+    relmon_id, _, relmon_name = file_name.partition('___')
+    report_stat = os.stat(report_path)
+    categories = get_report_categories(report_path)
+    return (relmon_id,
+            relmon_name,
+            file_name,
+            report_stat.st_size,
+            report_stat.st_mtime,
+            json.dumps(categories))
+
+
+def add_report(catalog_path, report_path):
+    """
+    Add or replace entry of a published report file
+    If there is no catalog yet, it is built from all report files, so
+    listing does not lose reports that were published before the catalog
+    """
+    if not os.path.isfile(catalog_path):
+        logging.info('Catalog %s does not exist, building it', catalog_path)
+        rebuild_catalog(catalog_path)
+        return
+
+    entry = get_report_entry(report_path)
+    connection = open_catalog(catalog_path)
+    try:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?)', entry)
+    finally:
+        connection.close()
+
+    logging.info('Added %s to catalog %s with categories %s', entry[2], catalog_path, entry[5])
+
+
+def remove_report(catalog_path, relmon_id):
+    """
+    Remove entry of a report from catalog
+    """
+    connection = open_catalog(catalog_path)
+    try:
+        with connection:
+            connection.execute('DELETE FROM reports WHERE id = ?', (relmon_id, ))
+    finally:
+        connection.close()
+
+    logging.info('Removed %s from catalog %s', relmon_id, catalog_path)
+
+
+def rebuild_catalog(catalog_path):
+    """
+    Replace all entries with entries of report files in catalog's directory
+    New catalog is built in a temporary file and then moved in place, so
+    catalog never exists without all entries
+    """
+    directory = os.path.dirname(os.path.abspath(catalog_path))
+    report_names = sorted(name for name in os.listdir(directory) if name.endswith('.sqlite'))
+    start_time = time.time()
+    entries = []
+    for report_name in report_names:
+        try:
+            entries.append(get_report_entry(os.path.join(directory, report_name)))
+        except (OSError, sqlite3.Error) as ex:
+            logging.error('Could not add %s to catalog: %s', report_name, ex)
+
+    new_catalog = not os.path.isfile(catalog_path)
+    if new_catalog:
+        target_path = '%s.%s.tmp' % (catalog_path, os.getpid())
+    else:
+        target_path = catalog_path
+
+    connection = open_catalog(target_path)
+    try:
+        with connection:
+            connection.execute('DELETE FROM reports')
+            connection.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?)',
+                                   entries)
+    finally:
+        connection.close()
+
+    if new_catalog:
+        os.rename(target_path, catalog_path)
+
+    logging.info('Rebuilt catalog of %s reports in %.2fs', len(entries), time.time() - start_time)
+
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description='Update catalog of published reports')
+    parser.add_argument('--catalog',
+                        type=str,
+                        default=CATALOG_FILE,
+                        help='Catalog file in directory of reports')
+    parser.add_argument('action',
+                        choices=['add', 'remove', 'rebuild'],
+                        help='Add report file, remove report ID or rebuild whole catalog')
+    parser.add_argument('target',
+                        nargs='?',
+                        help='Report file to add or report ID to remove')
+    args = vars(parser.parse_args())
+    logging.basicConfig(stream=sys.stdout,
+                        format='[%(asctime)s][%(levelname)s] %(message)s',
+                        level=logging.INFO)
+    action = args['action']
+    if action == 'add':
+        add_report(args['catalog'], args['target'])
+    elif action == 'remove':
+        remove_report(args['catalog'], args['target'])
+    else:
+        rebuild_catalog(args['catalog'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Module that prepares ValidationMatrix reports for the web
+"""
+import gzip
+import logging
+import os
+import shutil
+import time
+from multiprocessing import Pool
+
+
+# Prefix of style paths in HTML files that must be removed
+BLUEPRINT_PATH = b'/cms-service-reldqm/style/blueprint/'
+
+
+def process_file(paths):
+    """
+    Fix blueprint paths if it is a HTML file, gzip it and write to destination
+    Return sizes of source and destination files
+    """
+    source_path, destination_path = paths
+    with open(source_path, 'rb') as source_file:
+        content = source_file.read()
+
+    if source_path.endswith('.html'):
+        content = content.replace(BLUEPRINT_PATH, b'')
+
+    # Zero mtime makes compressed file depend only on content
+    with open(destination_path, 'wb') as destination_file:
+        with gzip.GzipFile(filename='',
+                           mode='wb',
+                           fileobj=destination_file,
+                           mtime=0) as gzip_file:
+            gzip_file.write(content)
+
+        destination_size = destination_file.tell()
+
+    return len(content), destination_size
+
+
+def postprocess_report(source_directory, destination_directory, processes=1):
+    """
+    Walk through report once and write every file to the same relative path in
+    destination directory with fixed blueprint paths and gzip compression
+    Files are processed by a pool of processes, source directory is removed
+    """
+    start_time = time.time()
+    tasks = []
+    for root, _, files in os.walk(source_directory):
+        relative_root = os.path.relpath(root, source_directory)
+        destination_root = os.path.normpath(os.path.join(destination_directory, relative_root))
+        if not os.path.isdir(destination_root):
+            os.makedirs(destination_root)
+
+        for name in files:
+            tasks.append((os.path.join(root, name), os.path.join(destination_root, name)))
+
+    source_bytes = 0
+    destination_bytes = 0
+    if tasks:
+        pool = Pool(max(1, min(processes, len(tasks))))
+        try:
+            for file_source_bytes, file_destination_bytes in pool.imap_unordered(process_file,
+                                                                                 tasks,
+                                                                                 chunksize=64):
+                source_bytes += file_source_bytes
+                destination_bytes += file_destination_bytes
+        finally:
+            pool.close()
+            pool.join()
+
+    shutil.rmtree(source_directory, ignore_errors=True)
+    duration = max(time.time() - start_time, 0.001)
+    logging.info('Post-processed %s files of %s in %.2fs with %s processes: %.1f files/s, '
+                 '%.2fMB -> %.2fMB, %.2fMB/s',
+                 len(tasks),
+                 source_directory,
+                 duration,
+                 processes,
+                 len(tasks) / duration,
+                 source_bytes / (1024.0 * 1024.0),
+                 destination_bytes / (1024.0 * 1024.0),
+                 source_bytes / (1024.0 * 1024.0) / duration)
+    return len(tasks), source_bytes, destination_bytes
@@ -1,61 +1,350 @@
 """
 Convert directories with htmlgz files to SQLite database
+Database is loaded in bulk without syncing and each category is replaced in a
+single transaction only if it's manifest of file paths and hashes changed
+Category tables have either path and htmlgz columns or, in deduplicated
+schema, path and hash columns with contents stored in blobs table
+Tables are clustered on path and metadata table lists categories, so readers
+need neither a separate index lookup nor a catalog scan
 """
+import argparse
+import hashlib
 import sqlite3
 import os
 import logging
 import sys
+import time
 
-logging.basicConfig(stream=sys.stdout,
-                    format='[%(asctime)s][%(levelname)s] %(message)s',
-                    level=logging.INFO)
-
-categories = [entry for entry in os.listdir('.') if os.path.isdir(os.path.join('.', entry))]
-logging.info('Categories %s', categories)
-db_connection = sqlite3.connect('reports.sqlite')
-db_cursor = db_connection.cursor()
-indexes_to_create = []
-
-for category in categories:
-    # Create tables
-    logging.info('Recreating table for %s', category)
-    db_cursor.execute('DROP TABLE IF EXISTS %s;' % (category))
-    db_cursor.execute('DROP INDEX IF EXISTS %sIndex;' % (category))
-    db_cursor.execute('CREATE TABLE %s (path text, htmlgz blob);' % (category))
-    # Walk through files and add to database
-    files_inserted = 0
-    for root, dirs, files in os.walk(category, topdown=False):
+
+# Pragmas for a database that is written in bulk and then only read
+# Page size has effect only on a new database, rollback journal is kept, so
+# replacement of a category could be rolled back
+BULK_LOAD_PRAGMAS = ['PRAGMA page_size = 32768;',
+                     'PRAGMA journal_mode = DELETE;',
+                     'PRAGMA synchronous = OFF;',
+                     'PRAGMA locking_mode = EXCLUSIVE;',
+                     'PRAGMA temp_store = MEMORY;',
+                     'PRAGMA cache_size = -131072;']  # 128 megabytes
+# Version of database layout that is stored as user_version
+# 0 - heap tables with separate path index, 2 - WITHOUT ROWID tables and metadata
+SCHEMA_VERSION = 2
+# Tables that are not categories and their definitions
+SERVICE_TABLES = {'manifest': ('CREATE TABLE manifest (category text, '
+                               'path text, '
+                               'hash text, '
+                               'PRIMARY KEY (category, path)) WITHOUT ROWID;'),
+                  'blobs': 'CREATE TABLE blobs (hash text PRIMARY KEY, htmlgz blob) WITHOUT ROWID;',
+                  'metadata': ('CREATE TABLE metadata (category text PRIMARY KEY, '
+                               'files integer, '
+                               'bytes integer, '
+                               'deduplicated integer, '
+                               'build_time real) WITHOUT ROWID;')}
+
+
+def walk_files(category):
+    """
+    Yield paths of all files in category directory
+    """
+    for root, _, files in os.walk(category):
         for name in files:
-            file_path = os.path.join(root, name)
-            with open(file_path, 'rb') as f:
-                ablob = f.read()
-
-            db_cursor.execute("INSERT INTO %s VALUES (?, ?)" % (category), [file_path, ablob])
-            files_inserted += 1
-            if files_inserted % 1000 == 0:
-                logging.info('Commit after %s inserted files for %s', files_inserted, category)
-                db_connection.commit()
-
-        logging.info('Commit after %s inserted files for %s', files_inserted, category)
-        db_connection.commit()
-
-    db_connection.commit()
-    if files_inserted == 0:
-        logging.info('No files were inserted for %s, dropping empty table', category)
-        db_cursor.execute('DROP TABLE IF EXISTS %s;' % (category))
+            yield os.path.join(root, name)
+
+
+def read_files(file_paths, manifest):
+    """
+    Yield path, SQLite blob and SHA1 hash of content of each file
+    Paths and hashes are appended to manifest, so files are read only once
+    """
+    for file_path in file_paths:
+        with open(file_path, 'rb') as input_file:
+            content = input_file.read()
+
+        file_hash = hashlib.sha1(content).hexdigest()
+        manifest.append((file_path, file_hash))
+        yield file_path, sqlite3.Binary(content), file_hash
+
+
+def make_manifest(file_paths):
+    """
+    Return list of paths and SHA1 hashes of given files
+    Files are read in chunks, so content is not kept in memory
+    """
+    manifest = []
+    for file_path in file_paths:
+        file_hash = hashlib.sha1()
+        with open(file_path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+                file_hash.update(chunk)
+
+        manifest.append((file_path, file_hash.hexdigest()))
+
+    return manifest
+
+
+def get_table_columns(db_connection, table):
+    """
+    Return list of column names of a table, empty list if table does not exist
+    """
+    return [row[1] for row in db_connection.execute('PRAGMA table_info(%s);' % (table))]
+
+
+def get_tables(db_connection):
+    """
+    Return names of all tables in database
+    """
+    return [row[0] for row in db_connection.execute('SELECT name FROM sqlite_master '
+                                                    "WHERE type = 'table' "
+                                                    "AND name NOT LIKE 'sqlite_%'")]
+
+
+def get_category_table_statement(category, deduplicate):
+    """
+    Return statement that creates category table clustered on path
+    """
+    return 'CREATE TABLE %s (path text PRIMARY KEY, %s) WITHOUT ROWID;' % (
+        category,
+        'hash text' if deduplicate else 'htmlgz blob')
+
+
+def update_metadata(db_connection, category, deduplicate):
+    """
+    Update number of files, total size and build time of a category
+    """
+    if deduplicate:
+        query = ('SELECT COUNT(*), COALESCE(SUM(LENGTH(blobs.htmlgz)), 0) FROM %s '
+                 'JOIN blobs ON blobs.hash = %s.hash' % (category, category))
+    else:
+        query = 'SELECT COUNT(*), COALESCE(SUM(LENGTH(htmlgz)), 0) FROM %s' % (category)
+
+    files, total_bytes = db_connection.execute(query).fetchone()
+    db_connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)',
+                          (category, files, total_bytes, int(deduplicate), time.time()))
+
+
+def rebuild_table(db_connection, table, create_statement):
+    """
+    Copy table to a new table that is created by given statement
+    """
+    db_connection.execute('ALTER TABLE %s RENAME TO %s_old;' % (table, table))
+    db_connection.execute(create_statement)
+    db_connection.execute('INSERT INTO %s SELECT * FROM %s_old ORDER BY 1;' % (table, table))
+    db_connection.execute('DROP TABLE %s_old;' % (table))
+
+
+def migrate(db_connection):
+    """
+    Create service tables and convert tables of older layout to clustered tables
+    Missing manifests and metadata of old categories are filled in
+    """
+    schema_version = db_connection.execute('PRAGMA user_version;').fetchone()[0]
+    if schema_version >= SCHEMA_VERSION:
+        return
+
+    logging.info('Migrating database from version %s to %s', schema_version, SCHEMA_VERSION)
+    db_connection.create_function('sha1',
+                                  1,
+                                  lambda content: hashlib.sha1(content).hexdigest())
+    db_connection.execute('BEGIN;')
+    try:
+        tables = get_tables(db_connection)
+        for table, create_statement in SERVICE_TABLES.items():
+            if table in tables:
+                rebuild_table(db_connection, table, create_statement)
+            else:
+                db_connection.execute(create_statement)
+
+        for category in tables:
+            if category in SERVICE_TABLES:
+                continue
+
+            logging.info('Migrating %s', category)
+            deduplicate = 'hash' in get_table_columns(db_connection, category)
+            rebuild_table(db_connection,
+                          category,
+                          get_category_table_statement(category, deduplicate))
+            if not deduplicate:
+                db_connection.execute('INSERT OR IGNORE INTO manifest '
+                                      'SELECT ?, path, sha1(htmlgz) FROM %s' % (category),
+                                      (category, ))
+
+            update_metadata(db_connection, category, deduplicate)
+
+        db_connection.execute('PRAGMA user_version = %s;' % (SCHEMA_VERSION))
+        db_connection.execute('COMMIT;')
+    except Exception:
+        db_connection.execute('ROLLBACK;')
+        raise
+
+
+def insert_plain(db_connection, category, file_paths):
+    """
+    Insert files to category table with path and htmlgz columns
+    Return manifest of inserted files
+    """
+    manifest = []
+    db_connection.execute(get_category_table_statement(category, False))
+    db_connection.executemany('INSERT INTO %s VALUES (?, ?)' % (category),
+                              ((path, content) for path, content, _
+                               in read_files(file_paths, manifest)))
+    return manifest
+
+
+def insert_deduplicated(db_connection, category, file_paths):
+    """
+    Insert files to category table with path and hash columns and store
+    contents in blobs table, where each distinct content is stored once
+    Return manifest of inserted files
+    """
+    manifest = []
+    db_connection.execute(get_category_table_statement(category, True))
+    stored_hashes = set(row[0] for row in db_connection.execute('SELECT hash FROM blobs'))
+    new_blobs = 0
+    for path, content, file_hash in read_files(file_paths, manifest):
+        db_connection.execute('INSERT INTO %s VALUES (?, ?)' % (category), (path, file_hash))
+        if file_hash not in stored_hashes:
+            stored_hashes.add(file_hash)
+            db_connection.execute('INSERT INTO blobs VALUES (?, ?)', (file_hash, content))
+            new_blobs += 1
+
+    logging.info('%s of %s files of %s have new content',
+                 new_blobs,
+                 len(manifest),
+                 category)
+    return manifest
+
+
+def delete_unused_blobs(db_connection):
+    """
+    Delete contents that are no longer used by any deduplicated category
+    """
+    used_hashes = ['SELECT hash FROM %s' % (table) for table in get_tables(db_connection)
+                   if table not in SERVICE_TABLES
+                   and 'hash' in get_table_columns(db_connection, table)]
+    if used_hashes:
+        query = 'DELETE FROM blobs WHERE hash NOT IN (%s)' % (' UNION '.join(used_hashes))
     else:
-        indexes_to_create.append(category)
+        query = 'DELETE FROM blobs'
+
+    deleted_blobs = db_connection.execute(query).rowcount
+    if deleted_blobs:
+        logging.info('Deleted %s unused blobs', deleted_blobs)
+
+
+def load_category(db_connection, category, deduplicate=False):
+    """
+    Replace table and manifest of a category in a single transaction
+    Category is left alone if it's manifest and schema did not change
+    Files are hashed separately only if paths and schema did not change,
+    otherwise manifest is made while files are inserted
+    Return number of inserted files, None if category was not changed
+    """
+    # Sorted by path, so primary key index is built by appending
+    file_paths = sorted(walk_files(category))
+    columns = get_table_columns(db_connection, category)
+    old_manifest = [tuple(row) for row in db_connection.execute('SELECT path, hash '
+                                                                'FROM manifest '
+                                                                'WHERE category = ? '
+                                                                'ORDER BY path',
+                                                                (category, ))]
+    if (columns
+            and ('hash' in columns) == deduplicate
+            and file_paths == [path for path, _ in old_manifest]):
+        if make_manifest(file_paths) == old_manifest:
+            logging.info('Manifest of %s did not change, leaving it as it is', category)
+            return None
+
+    # Connection is in autocommit mode, so schema changes are in the same transaction
+    db_connection.execute('BEGIN;')
+    try:
+        logging.info('Recreating table for %s', category)
+        db_connection.execute('DROP TABLE IF EXISTS %s;' % (category))
+        db_connection.execute('DROP INDEX IF EXISTS %sIndex;' % (category))
+        db_connection.execute('DELETE FROM manifest WHERE category = ?', (category, ))
+        db_connection.execute('DELETE FROM metadata WHERE category = ?', (category, ))
+        manifest = []
+        if not file_paths:
+            logging.info('No files were found for %s, table will not be created', category)
+        else:
+            if deduplicate:
+                manifest = insert_deduplicated(db_connection, category, file_paths)
+            else:
+                manifest = insert_plain(db_connection, category, file_paths)
+
+            update_metadata(db_connection, category, deduplicate)
+
+        db_connection.executemany('INSERT INTO manifest VALUES (?, ?, ?)',
+                                  ((category, path, file_hash) for path, file_hash in manifest))
+        delete_unused_blobs(db_connection)
+
+        db_connection.execute('COMMIT;')
+    except Exception:
+        db_connection.execute('ROLLBACK;')
+        raise
+
+    return len(manifest)
+
+
+def get_fragmentation(db_connection):
+    """
+    Return fraction of database pages that are free
+    """
+    page_count = db_connection.execute('PRAGMA page_count;').fetchone()[0]
+    freelist_count = db_connection.execute('PRAGMA freelist_count;').fetchone()[0]
+    return float(freelist_count) / max(1, page_count)
+
+
+def sqltify(database_name='reports.sqlite', fragmentation_threshold=0.2, deduplicate=False):
+    """
+    Load all category directories in current directory to SQLite database
+    Only categories that changed are rewritten and space is reclaimed only
+    if more than given fraction of database is free pages
+    If deduplicate is True, changed categories are stored in deduplicated schema
+    """
+    categories = sorted(entry for entry in os.listdir('.') if os.path.isdir(entry))
+    logging.info('Categories %s', categories)
+    db_connection = sqlite3.connect(database_name, isolation_level=None)
+    for pragma in BULK_LOAD_PRAGMAS:
+        db_connection.execute(pragma)
+
+    migrate(db_connection)
+    for category in categories:
+        start_time = time.time()
+        files_inserted = load_category(db_connection, category, deduplicate)
+        if files_inserted is None:
+            continue
+
+        duration = max(time.time() - start_time, 0.001)
+        logging.info('Inserted %s files for %s in %.2fs, %.1f files/s',
+                     files_inserted,
+                     category,
+                     duration,
+                     files_inserted / duration)
 
-    db_connection.commit()
+    # Reclaim space only if there are many pages of deleted entries
+    fragmentation = get_fragmentation(db_connection)
+    logging.info('Free pages: %.2f%%', fragmentation * 100)
+    if fragmentation > fragmentation_threshold:
+        logging.info('Free pages exceed %.2f%%, running VACUUM', fragmentation_threshold * 100)
+        db_connection.execute('VACUUM;')
 
-# Reclaim space from deleted entries
-db_cursor.execute('VACUUM;')
-db_connection.commit()
+    db_connection.close()
 
-# Create index
-for category in indexes_to_create:
-    logging.info('Creating index for %s', category)
-    db_cursor.execute('CREATE INDEX %sIndex ON %s(path)' % (category, category))
 
-db_connection.commit()
-db_connection.close()
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout,
+                        format='[%(asctime)s][%(levelname)s] %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Load report directories to SQLite database')
+    parser.add_argument('--database',
+                        type=str,
+                        default='reports.sqlite',
+                        help='SQLite database file')
+    parser.add_argument('--fragmentation',
+                        type=float,
+                        default=0.2,
+                        help='Fraction of free pages above which database is vacuumed')
+    parser.add_argument('--deduplicate',
+                        action='store_true',
+                        help='Store each distinct file content once in blobs table')
+    args = vars(parser.parse_args())
+    sqltify(args['database'], args['fragmentation'], args['deduplicate'])
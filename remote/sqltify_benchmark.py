@@ -0,0 +1,108 @@
+"""
+Benchmark of sqltify against the previous row by row loader
+Creates synthetic report directories in a temporary directory and loads
+them with both loaders
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from sqltify import sqltify
+
+
+def legacy_sqltify(database_name='reports.sqlite'):
+    """
+    Previous sqltify: row by row inserts, commit every 1000 files, VACUUM and
+    indexes built after load
+    """
+    categories = [entry for entry in os.listdir('.') if os.path.isdir(os.path.join('.', entry))]
+    db_connection = sqlite3.connect(database_name)
+    db_cursor = db_connection.cursor()
+    indexes_to_create = []
+    for category in categories:
+        db_cursor.execute('DROP TABLE IF EXISTS %s;' % (category))
+        db_cursor.execute('DROP INDEX IF EXISTS %sIndex;' % (category))
+        db_cursor.execute('CREATE TABLE %s (path text, htmlgz blob);' % (category))
+        files_inserted = 0
+        for root, _, files in os.walk(category, topdown=False):
+            for name in files:
+                file_path = os.path.join(root, name)
+                with open(file_path, 'rb') as input_file:
+                    ablob = input_file.read()
+
+                db_cursor.execute('INSERT INTO %s VALUES (?, ?)' % (category),
+                                  [file_path, ablob])
+                files_inserted += 1
+                if files_inserted % 1000 == 0:
+                    db_connection.commit()
+
+            db_connection.commit()
+
+        if files_inserted == 0:
+            db_cursor.execute('DROP TABLE IF EXISTS %s;' % (category))
+        else:
+            indexes_to_create.append(category)
+
+        db_connection.commit()
+
+    db_cursor.execute('VACUUM;')
+    db_connection.commit()
+    for category in indexes_to_create:
+        db_cursor.execute('CREATE INDEX %sIndex ON %s(path)' % (category, category))
+
+    db_connection.commit()
+    db_connection.close()
+
+
+def make_reports(directory, categories, files, file_size):
+    """
+    Make category directories with given number of random files in each
+    """
+    for category_index in range(categories):
+        category = 'Category%sReport' % (category_index)
+        for file_index in range(files):
+            subdirectory = os.path.join(directory, category, 'RelVal%s' % (file_index % 100))
+            if not os.path.isdir(subdirectory):
+                os.makedirs(subdirectory)
+
+            size = random.randint(file_size // 2, file_size * 3 // 2)
+            with open(os.path.join(subdirectory, '%s.html' % (file_index)), 'wb') as output_file:
+                output_file.write(os.urandom(size))
+
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description='Benchmark of sqltify')
+    parser.add_argument('--categories', type=int, default=4, help='Number of categories')
+    parser.add_argument('--files', type=int, default=25000, help='Number of files in category')
+    parser.add_argument('--size', type=int, default=4096, help='Average file size in bytes')
+    args = vars(parser.parse_args())
+    directory = tempfile.mkdtemp(prefix='sqltify_benchmark_')
+    old_directory = os.getcwd()
+    try:
+        make_reports(directory, args['categories'], args['files'], args['size'])
+        os.chdir(directory)
+        for name, loader in (('legacy', legacy_sqltify), ('bulk', sqltify)):
+            for run in ('new database', 'existing database'):
+                start_time = time.time()
+                loader('%s.sqlite' % (name))
+                duration = time.time() - start_time
+                total_files = args['categories'] * args['files']
+                print('%-6s %-17s %7.2fs %9.1f files/s %8.2fMB' % (
+                    name,
+                    run,
+                    duration,
+                    total_files / duration,
+                    os.path.getsize('%s.sqlite' % (name)) / (1024.0 * 1024.0)))
+    finally:
+        os.chdir(old_directory)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Compare sizes of existing report SQLite files with their deduplicated copies
+Deduplicated copy is made in a temporary file and deleted afterwards
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import tempfile
+from sqltify import (BULK_LOAD_PRAGMAS,
+                     SERVICE_TABLES,
+                     get_category_table_statement,
+                     get_table_columns)
+
+
+def deduplicate_report(report_name, deduplicated_name):
+    """
+    Copy all plain category tables of a report to deduplicated schema
+    Return number of files and number of distinct contents
+    """
+    report_connection = sqlite3.connect(report_name)
+    deduplicated_connection = sqlite3.connect(deduplicated_name)
+    for pragma in BULK_LOAD_PRAGMAS:
+        deduplicated_connection.execute(pragma)
+
+    deduplicated_connection.execute(SERVICE_TABLES['blobs'])
+    tables = [row[0] for row in report_connection.execute('SELECT name FROM sqlite_master '
+                                                          "WHERE type = 'table' ORDER BY name")]
+    hashes = set()
+    files = 0
+    for table in tables:
+        if table in SERVICE_TABLES or 'htmlgz' not in get_table_columns(report_connection, table):
+            continue
+
+        deduplicated_connection.execute(get_category_table_statement(table, True))
+        for path, content in report_connection.execute('SELECT path, htmlgz FROM %s '
+                                                       'ORDER BY path' % (table)):
+            content = bytes(content)
+            content_hash = hashlib.sha1(content).hexdigest()
+            files += 1
+            deduplicated_connection.execute('INSERT INTO %s VALUES (?, ?)' % (table),
+                                            (path, content_hash))
+            if content_hash not in hashes:
+                hashes.add(content_hash)
+                deduplicated_connection.execute('INSERT INTO blobs VALUES (?, ?)',
+                                                (content_hash, sqlite3.Binary(content)))
+
+    deduplicated_connection.commit()
+    deduplicated_connection.close()
+    report_connection.close()
+    return files, len(hashes)
+
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description='Compare sizes of report files with their '
+                                                 'deduplicated copies')
+    parser.add_argument('reports', nargs='+', help='Report SQLite files')
+    args = vars(parser.parse_args())
+    megabyte = 1024.0 * 1024.0
+    print('%-50s %8s %8s %10s %10s %7s' % ('Report',
+                                           'Files',
+                                           'Distinct',
+                                           'Size MB',
+                                           'Dedup MB',
+                                           'Ratio'))
+    for report_name in args['reports']:
+        handle, deduplicated_name = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        os.remove(deduplicated_name)
+        try:
+            files, distinct = deduplicate_report(report_name, deduplicated_name)
+            size = os.path.getsize(report_name)
+            deduplicated_size = os.path.getsize(deduplicated_name)
+        finally:
+            if os.path.isfile(deduplicated_name):
+                os.remove(deduplicated_name)
+
+        print('%-50s %8s %8s %10.2f %10.2f %6.1f%%' % (os.path.basename(report_name)[-50:],
+                                                      files,
+                                                      distinct,
+                                                      size / megabyte,
+                                                      deduplicated_size / megabyte,
+                                                      100.0 * deduplicated_size / max(1, size)))
+
+
+if __name__ == '__main__':
+    main()
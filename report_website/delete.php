@@ -3,5 +3,13 @@ $authorizedUser = in_array('cms-ppd-pdmv-val-admin-pdmv', explode(';', strtolowe
 $name = $_POST['name'];
 if ($authorizedUser) {
   unlink($name . '.sqlite');
+  if (file_exists('./reports_catalog.db')) {
+    $catalog = new SQLite3('./reports_catalog.db');
+    $catalog->busyTimeout(10000);
+    $statement = $catalog->prepare("DELETE FROM reports WHERE id = :id;");
+    $statement->bindValue(':id', explode('___', basename($name))[0], SQLITE3_TEXT);
+    $statement->execute();
+    $catalog->close();
+  }
 }
 ?>
@@ -71,33 +71,64 @@ if (!isset($_SERVER["PATH_INFO"])) {
         </div>
 
   <?php
-        $relmons = glob('./*.sqlite');
+        $q = "";
         if (isset($_GET["q"])) {
             $q = $_GET["q"];
-            $regexQuery = str_replace("*", ".*", "/*" . $q . "*/i");
-            $relmons = array_filter($relmons, function($k) use ($regexQuery) {
-              return preg_match($regexQuery, $k);
-            });
         }
-        usort($relmons, function($a, $b) { return filemtime($a) < filemtime($b); });
-        $totalRelmons = count($relmons);
         $page = 0;
         $pageSize = 10;
         if (isset($_GET["page"])) {
-            $page = $_GET["page"];
+            $page = intval($_GET["page"]);
+        }
+        $relmons = array();
+        if (file_exists('./reports_catalog.db')) {
+            # Catalog is updated by jobs, so report files are not touched
+            $catalog = new SQLite3('./reports_catalog.db', SQLITE3_OPEN_READONLY);
+            $likeQuery = '%' . str_replace(array('\\', '%', '_', '*'), array('\\\\', '\\%', '\\_', '%'), $q) . '%';
+            $countStatement = $catalog->prepare("SELECT COUNT(*) FROM reports WHERE file_name LIKE :q ESCAPE '\\';");
+            $countStatement->bindValue(':q', $likeQuery, SQLITE3_TEXT);
+            $totalRelmons = $countStatement->execute()->fetchArray(SQLITE3_NUM)[0];
+            $statement = $catalog->prepare("SELECT file_name, size, mtime, categories FROM reports WHERE file_name LIKE :q ESCAPE '\\' ORDER BY mtime DESC LIMIT :limit OFFSET :offset;");
+            $statement->bindValue(':q', $likeQuery, SQLITE3_TEXT);
+            $statement->bindValue(':limit', $pageSize, SQLITE3_INTEGER);
+            $statement->bindValue(':offset', $page * $pageSize, SQLITE3_INTEGER);
+            $result = $statement->execute();
+            while ($row = $result->fetchArray(SQLITE3_ASSOC)) {
+              $relmons[] = array('path' => './' . $row['file_name'] . '.sqlite',
+                                 'size' => $row['size'],
+                                 'mtime' => $row['mtime'],
+                                 'categories' => json_decode($row['categories']));
+            }
+            $catalog->close();
+        } else {
+            $relmonFiles = glob('./*.sqlite');
+            if ($q) {
+                $regexQuery = str_replace("*", ".*", "/*" . $q . "*/i");
+                $relmonFiles = array_filter($relmonFiles, function($k) use ($regexQuery) {
+                  return preg_match($regexQuery, $k);
+                });
+            }
+            usort($relmonFiles, function($a, $b) { return filemtime($a) < filemtime($b); });
+            $totalRelmons = count($relmonFiles);
+            foreach (array_slice($relmonFiles, $page * $pageSize, $pageSize) as $relmonFile) {
+              $stat = stat($relmonFile);
+              $relmons[] = array('path' => $relmonFile,
+                                 'size' => $stat['size'],
+                                 'mtime' => $stat['mtime'],
+                                 'categories' => null);
+            }
         }
-        $relmons = array_slice($relmons, $page * $pageSize, $pageSize);
 
-        foreach($relmons as $relmon) {
+        foreach($relmons as $entry) {
+          $relmon = $entry['path'];
   ?>
           <div class="row card mt-2 elevation-3">
             <div class="card-body">
               <div class="row">
                 <div class="col-sm-12 col-md-8">
   <?php
-                  $stat = stat($relmon);
-                  $lastModified = date("Y-m-d H:i", $stat['mtime']);
-                  $size = round($stat['size'] / (1024.0 * 1024.0), 2);
+                  $lastModified = date("Y-m-d H:i", $entry['mtime']);
+                  $size = round($entry['size'] / (1024.0 * 1024.0), 2);
                   $relmonName = str_replace("./", "", $relmon);
                   $relmonName = str_replace(".sqlite", "", $relmonName);
                   $explodedRelmonName = explode("___", $relmonName);
@@ -116,13 +147,24 @@ if (!isset($_SERVER["PATH_INFO"])) {
                   <ul>
   <?php
                     try {
-                      $handle = new SQLite3($relmon);
-                      $tablesquery = $handle->query("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name;");
-                      while ($table = $tablesquery->fetchArray(SQLITE3_ASSOC)) {
-                        $category = $table['name'];
+                      $categories = $entry['categories'];
+                      if ($categories === null) {
+                        $categories = array();
+                        $handle = new SQLite3($relmon, SQLITE3_OPEN_READONLY);
+                        if ($handle->querySingle("PRAGMA user_version;") >= 2) {
+                          # Categories are listed in metadata table
+                          $tablesquery = $handle->query("SELECT category AS name FROM metadata ORDER BY category;");
+                        } else {
+                          $tablesquery = $handle->query("SELECT name FROM sqlite_master WHERE type='table' AND name NOT IN ('manifest', 'blobs', 'metadata') ORDER BY name;");
+                        }
+                        while ($table = $tablesquery->fetchArray(SQLITE3_ASSOC)) {
+                          $categories[] = $table['name'];
+                        }
+                        $handle->close();
+                      }
+                      foreach ($categories as $category) {
                         print("<li><a href=\"$relmonName/$category/RelMonSummary.html\">$category</a></li>");
                       }
-                      $handle->close();
                     } catch (Exception $e) {
                       print("<li><i>Error getting subcategories. Error:" + $e->getMessage());
                     }
@@ -196,9 +238,42 @@ if (!isset($_SERVER["PATH_INFO"])) {
   if (!file_exists($dbFileName)) {
     echo "";
   } else {
-    $handle = new SQLite3($dbFileName);
-    $queryString = "SELECT htmlgz FROM $category WHERE path='$fileName';";
-    $result = $handle->querySingle($queryString);
+    $handle = new SQLite3($dbFileName, SQLITE3_OPEN_READONLY);
+    # Category is a table name, it cannot be a query parameter
+    $columns = array();
+    if (preg_match('/^[A-Za-z0-9_]+$/', $category)) {
+      if ($handle->querySingle("PRAGMA user_version;") >= 2) {
+        # Schema of category is in metadata table, no need to look at catalog
+        $metadataStatement = $handle->prepare("SELECT deduplicated FROM metadata WHERE category = :category;");
+        $metadataStatement->bindValue(':category', $category, SQLITE3_TEXT);
+        $metadata = $metadataStatement->execute()->fetchArray(SQLITE3_NUM);
+        if ($metadata) {
+          $columns = array('path', $metadata[0] ? 'hash' : 'htmlgz');
+        }
+      } else {
+        # Old files
+        $columnsQuery = $handle->query("PRAGMA table_info(\"$category\");");
+        while ($column = $columnsQuery->fetchArray(SQLITE3_ASSOC)) {
+          $columns[] = $column['name'];
+        }
+      }
+    }
+    $result = "";
+    if (in_array('htmlgz', $columns)) {
+      $statement = $handle->prepare("SELECT htmlgz FROM \"$category\" WHERE path = :path;");
+    } else if (in_array('hash', $columns)) {
+      # Deduplicated schema, content is in blobs table
+      $statement = $handle->prepare("SELECT blobs.htmlgz FROM \"$category\" JOIN blobs ON blobs.hash = \"$category\".hash WHERE \"$category\".path = :path;");
+    } else {
+      $statement = null;
+    }
+    if ($statement) {
+      $statement->bindValue(':path', $fileName, SQLITE3_TEXT);
+      $row = $statement->execute()->fetchArray(SQLITE3_NUM);
+      if ($row) {
+        $result = $row[0];
+      }
+    }
     $handle->close();
     echo $result;
   }